@@ -1,11 +1,10 @@
 from flask import Flask, request, jsonify, send_file, render_template, session
-from flask import send_from_directory, abort
+from flask import send_from_directory, abort, Response, stream_with_context
 from werkzeug.utils import safe_join, secure_filename
 import os
 import re
 import glob
 import subprocess
-from Bio.PDB import PDBParser
 import numpy as np
 import time
 import json
@@ -15,6 +14,17 @@ import zipfile
 import shutil
 import sys
 
+from ligand_prep import prepare_ligands, prepare_library, VALID_EXTS
+from job_queue import JobQueue, QUEUED, RUNNING
+from run_progress import ProgressTracker, read_log_chunk
+from receptor_arrays import ReceptorCache
+from receptor_store import ReceptorStore
+from results_store import ResultsStore, STORE_NAME, lock_results_dir, lock_holder
+from results_archive import MemberCache, zip_stream, results_members, selected_members
+from results_table import ResultsTableCache, SORT_KEYS
+from box_sizing import ExtentCache, fit_box_edge, box_estimate, BOX_FIT_METHODS
+from pockets import detect_pockets
+
 # EXACT PATH defined by you
 # app.py
 
@@ -31,7 +41,6 @@ PREPARE_RECEPTOR = "/home/atharva/Downloads/mgltools_x86_64Linux2_1.5.7/MGLTools
 # find ~ -name "prepare_receptor4.py"
 app = Flask(__name__, static_folder='static', template_folder='templates')
 app.secret_key = os.urandom(24)
-running_processes = {}
 
 @app.route('/')
 def home():
@@ -43,6 +52,26 @@ PROJECT = './workspace/projects'
 
 app.config['WORKSPACE'] = WORKSPACE
 app.config['PROJECT'] = PROJECT
+# Converted ligands keyed by content hash, shared by all projects
+app.config['LIGAND_CACHE'] = os.path.join(WORKSPACE, 'cache', 'ligands')
+app.config['LIGAND_PREP_WORKERS'] = os.cpu_count()
+# Single indexed ligand file used instead of ligand/pdbqt in library mode
+LIBRARY_NAME = 'library.pdbqt'
+# Prepared receptors of an ensemble, under the project's receptor folder
+ENSEMBLE_DIR = 'ensemble'
+# Ligand prep, receptor prep and docking run as queued jobs. Docking has
+# its own limit (DOCKING_JOBS at once, each given an equal share of the
+# cores), so long runs never hold the JOB_WORKERS slots kept for prep jobs.
+app.config['JOB_DB'] = os.path.join(WORKSPACE, 'jobs.db')
+app.config['JOB_WORKERS'] = 2
+app.config['DOCKING_JOBS'] = 2
+# Memory bound for parsed receptor arrays kept between /grid calls
+app.config['RECEPTOR_CACHE_BYTES'] = 512 * 1024 * 1024
+# Prepared receptor.pdbqt files keyed by input PDB hash + MGLTools options
+app.config['RECEPTOR_STORE'] = os.path.join(WORKSPACE, 'cache', 'receptors')
+app.config['RECEPTOR_STORE_BYTES'] = 2 * 1024 * 1024 * 1024
+# Vina affinity maps shared by all runs against the same receptor and box
+app.config['MAPS_CACHE'] = os.path.join(WORKSPACE, 'cache', 'maps')
 
 # Create directories if missing
 os.makedirs(WORKSPACE, exist_ok=True)
@@ -74,17 +103,26 @@ def upload_rec():
     if not project_path:
         return jsonify({'error': 'No active project. Please create a project first.'}), 400
 
-    file = request.files.get('file')
-    if not file or not file.filename.endswith('.pdb'):
+    # Several PDBs (conformers or homologs) make an ensemble; the first one
+    # is shown in the viewer and used for the grid
+    files = request.files.getlist('file')
+    if not files or not all(file.filename.endswith('.pdb') for file in files):
         return jsonify({'error': 'Invalid file type. Please upload a PDB file.'}), 400
     
     upload_folder = os.path.join(project_path, 'receptor')
     os.makedirs(upload_folder, exist_ok=True)
 
-    filepath = os.path.join(upload_folder, file.filename)
-    file.save(filepath)
+    # A new upload replaces the previous receptor set
+    for old_pdb in glob.glob(os.path.join(upload_folder, '*.pdb')):
+        os.remove(old_pdb)
+
+    filepaths = []
+    for file in files:
+        filepath = os.path.join(upload_folder, secure_filename(file.filename))
+        file.save(filepath)
+        filepaths.append(filepath)
 
-    return jsonify({'message': 'File uploaded successfully!', 'filepath': filepath})
+    return jsonify({'message': 'File uploaded successfully!', 'filepath': filepaths[0], 'filepaths': filepaths})
 
 @app.route('/lig_upload', methods=['POST'])
 def upload_lig():
@@ -95,8 +133,9 @@ def upload_lig():
     ligand_dir = os.path.join(project_path, 'ligand')
     pdbqt_dir = os.path.join(ligand_dir, 'pdbqt') 
 
-    # --- NEW: CLEAR EXISTING LIGANDS FIRST ---
-    # This deletes the entire 'ligand' folder and everything inside it (pdbqt, zips, sdfs)
+    # --- CLEAR THE PREVIOUS LIGAND SET ---
+    # Uploads and the project's pdbqt folder are replaced; converted
+    # molecules stay in the shared cache and are relinked when re-uploaded.
     if os.path.exists(ligand_dir):
         try:
             shutil.rmtree(ligand_dir)
@@ -115,8 +154,12 @@ def upload_lig():
         if filename:
             file.save(os.path.join(ligand_dir, filename))
 
+    # Library mode streams records (zips included) into one indexed file
+    # instead of writing one .pdbqt per molecule
+    library = request.form.get('library') == 'true'
+
     # --- 2. Unzip Zips ---
-    for zip_file in glob.glob(os.path.join(ligand_dir, '*.zip')):
+    for zip_file in ([] if library else glob.glob(os.path.join(ligand_dir, '*.zip'))):
         try:
             with zipfile.ZipFile(zip_file, 'r') as z:
                 z.extractall(ligand_dir)
@@ -124,52 +167,53 @@ def upload_lig():
         except Exception as e:
             print(f"Error unzipping {zip_file}: {e}")
 
-    # --- 3. Convert ALL molecules to PDBQT ---
-    valid_exts = ('.mol2', '.sdf', '.mol', '.cif', '.pdb')
-    # Filter to ignore directories or unrelated files
-    raw_files = [f for f in os.listdir(ligand_dir) 
-                 if f.lower().endswith(valid_exts) and os.path.isfile(os.path.join(ligand_dir, f))]
-    
-    converted_count = 0
-    errors = []
-
-    for f in raw_files:
-        input_path = os.path.join(ligand_dir, f)
-        base_name = os.path.splitext(f)[0]
-        output_path = os.path.join(pdbqt_dir, base_name + '.pdbqt')
-
-        # OBABEL COMMAND
-        cmd = [
-            'obabel', input_path,
-            '-O', output_path,
-            '--gen3d',
-            '--minimize',
-            '--ff', 'mmff94',
-            '-xh',
-            '--partialcharge', 'gasteiger'
-        ]
-        
-        try:
-            subprocess.run(cmd, check=True)
-            converted_count += 1
-        except subprocess.CalledProcessError:
-            errors.append(f)
+    # --- 3. Queue conversion of ALL molecules to PDBQT ---
+    job_id = job_queue.submit(project_path, 'ligand_prep', {
+        'ligand_dir': ligand_dir,
+        'pdbqt_dir': pdbqt_dir,
+        'library': library
+    })
+
+    return jsonify({'message': 'Ligand preparation queued.', 'job_id': job_id}), 202
+
+def run_ligand_prep(payload):
+    ligand_dir = payload['ligand_dir']
+    pdbqt_dir = payload['pdbqt_dir']
+
+    # Multi-molecule SDF/MOL2 files are split into one record per molecule
+    # and converted in parallel, reusing cached results for identical input.
+    # Uploaded .pdbqt ligands are already prepared and are used as they are.
+    raw_files = [os.path.join(ligand_dir, f) for f in os.listdir(ligand_dir)
+                 if f.lower().endswith(VALID_EXTS) and os.path.isfile(os.path.join(ligand_dir, f))]
+
+    if payload.get('library'):
+        zips = glob.glob(os.path.join(ligand_dir, '*.zip'))
+        library_path = os.path.join(ligand_dir, LIBRARY_NAME)
+        count, cached_count, errors = prepare_library(
+            raw_files + zips, library_path, app.config['LIGAND_CACHE'], app.config['LIGAND_PREP_WORKERS'])
+        if count == 0:
+            return 1, 'No valid ligands found or conversion failed.', None
+
+        msg = f"Processed {count} ligands into a library."
+        if cached_count: msg += f" Reused from cache: {cached_count}."
+        if errors: msg += f" Failed: {len(errors)}"
+        return 0, msg, {'count': count, 'failed': errors, 'library': library_path}
+
+    converted, cached_count, errors = prepare_ligands(
+        raw_files, pdbqt_dir, app.config['LIGAND_CACHE'], app.config['LIGAND_PREP_WORKERS'])
+    converted_count = len(converted)
 
     if converted_count == 0:
-         # It's possible the user uploaded only .pdbqt files (no conversion needed)
-         # If so, we should copy them to the pdbqt dir or just count them if they exist
-         existing_pdbqt = glob.glob(os.path.join(ligand_dir, '*.pdbqt'))
-         if existing_pdbqt:
-             for p in existing_pdbqt:
-                 shutil.move(p, pdbqt_dir)
-             converted_count = len(existing_pdbqt)
-         else:
-             return jsonify({'error': 'No valid ligands found or conversion failed.'}), 500
+        return 1, 'No valid ligands found or conversion failed.', None
 
     msg = f"Processed {converted_count} ligands."
+    if cached_count: msg += f" Reused from cache: {cached_count}."
     if errors: msg += f" Failed: {len(errors)}"
 
-    return jsonify({'message': msg, 'count': converted_count})
+    return 0, msg, {'count': converted_count, 'failed': errors}
+
+receptor_cache = ReceptorCache(app.config['RECEPTOR_CACHE_BYTES'])
+receptor_store = ReceptorStore(app.config['RECEPTOR_STORE'], app.config['RECEPTOR_STORE_BYTES'])
 
 @app.route('/grid', methods=['POST'])
 def generate_grid():
@@ -183,34 +227,36 @@ def generate_grid():
         if not filepath or not os.path.exists(filepath):
             return jsonify({'error': 'File not found. Please upload a valid file.'}), 400
 
-        parser = PDBParser()
-        structure = parser.get_structure('protein', filepath)
+        receptor = receptor_cache.get(filepath)
 
-        coords = []
+        # Selections are boolean masks over the receptor's atom arrays
         if mode == 'blind':
-            for atom in structure.get_atoms():
-                coords.append(atom.coord)
+            mask = np.ones(len(receptor), dtype=bool)
         elif mode == 'targeted':
             if not residues:
                 return jsonify({'error': 'No residues specified for targeted docking.'}), 400
-            for residue in residues:
-                residue = residue.strip()
-                chain_id, res_id = residue.split(':')
-                chain_id = chain_id.strip()
-                res_id = res_id.strip()
-                for chain in structure.get_chains():
-                    if chain.id == chain_id:
-                        for res in chain.get_residues():
-                            if res.id[1] == int(res_id):
-                                for atom in res:
-                                    coords.append(atom.coord)
+            try:
+                mask = receptor.residue_mask(residues)
+            except ValueError:
+                return jsonify({'error': 'Residues must be given as chain:resid, e.g. A:145.'}), 400
+        elif mode == 'ligand':
+            # Box around a bound ligand / HETATM group, by residue name
+            ligand_resname = data.get('ligand_resname', '')
+            if not ligand_resname:
+                return jsonify({'error': 'No ligand residue name specified.'}), 400
+            mask = receptor.resname_mask(ligand_resname)
         else:
             return jsonify({'error': 'Invalid mode selected.'}), 400
 
-        if not coords:
+        # Optionally grow the selection to every atom within radius (A)
+        radius = float(data.get('radius') or 0)
+        if radius > 0 and mode != 'blind':
+            mask = receptor.within(mask, radius)
+
+        coords = receptor.coords[mask]
+        if len(coords) == 0:
             return jsonify({'error': 'No atoms found for the specified residues.'}), 400
 
-        coords = np.array(coords)
         min_coords = coords.min(axis=0) - 5
         max_coords = coords.max(axis=0) + 5
 
@@ -240,12 +286,28 @@ size_z = {size[2]}
         'size_z': float(size[2]),
         }
 
-        return jsonify({
+        response = {
             'message': 'Grid configuration generated!',
             'config_file': config_filename,
             'config_path': config_path,
-            'grid_dimensions': grid_dimensions
-        })
+            'grid_dimensions': grid_dimensions,
+            'atom_count': int(len(coords))
+        }
+
+        # Blind mode: ranked pocket sub-boxes, docked instead of the whole
+        # protein when the docking parameters ask for the top pockets.
+        # HETATM records (waters, bound ligands) do not fill the pockets.
+        if mode == 'blind' and data.get('pockets'):
+            protein = receptor.coords[~receptor.hetero]
+            if len(protein) == 0:
+                return jsonify({'error': 'No protein (ATOM) atoms to search for pockets.'}), 400
+            pockets = detect_pockets(protein, max_pockets=int(data.get('max_pockets') or 10))
+            os.makedirs(os.path.join(project_path, 'params'), exist_ok=True)
+            with open(os.path.join(project_path, 'params', 'pockets.json'), 'w') as f:
+                json.dump(pockets, f, indent=4)
+            response['pockets'] = pockets
+
+        return jsonify(response)
     except Exception as e:
         app.logger.error(f"Error during grid generation: {e}")
         return jsonify({'error': 'An error occurred during grid generation.'}), 500
@@ -270,30 +332,112 @@ def prepare_receptor():
     pdb_files = glob.glob(os.path.join(receptor_dir, '*.pdb'))
     if not pdb_files: return jsonify({'error': 'No PDB file found.'}), 400
     
-    input_pdb = os.path.abspath(pdb_files[0])
+    # The receptor shown in the viewer becomes receptor.pdbqt
+    filepath = data.get('filepath')
+    if filepath and os.path.abspath(filepath) in map(os.path.abspath, pdb_files):
+        input_pdb = os.path.abspath(filepath)
+    else:
+        input_pdb = os.path.abspath(sorted(pdb_files)[0])
     output_pdbqt = os.path.abspath(os.path.join(receptor_dir, 'receptor.pdbqt'))
 
-    # 3. Construct Command
-    cmd = [MGL_PYTHON, PREPARE_RECEPTOR, '-r', input_pdb, '-o', output_pdbqt, '-A', 'checkhydrogens']
-    
-    print(f"--- EXECUTING MGLTOOLS ---\nCommand: {' '.join(cmd)}")
-
+    # Ensemble: every uploaded PDB is prepared into receptor/ensemble
+    ensemble_dir = os.path.join(receptor_dir, ENSEMBLE_DIR)
+    shutil.rmtree(ensemble_dir, ignore_errors=True)
+    ensemble = []
+    if len(pdb_files) > 1:
+        for pdb in sorted(pdb_files):
+            name = os.path.splitext(os.path.basename(pdb))[0]
+            ensemble.append((os.path.abspath(pdb), os.path.abspath(os.path.join(ensemble_dir, name + '.pdbqt'))))
+
+    # 3. Queue MGLTools
+    job_id = job_queue.submit(project_path, 'receptor_prep', {
+        'input_pdb': input_pdb,
+        'output_pdbqt': output_pdbqt,
+        'ensemble': ensemble
+    })
+
+    return jsonify({'message': 'Receptor preparation queued.', 'job_id': job_id}), 202
+
+def run_receptor_prep(payload):
+    input_pdb = payload['input_pdb']
+    output_pdbqt = payload['output_pdbqt']
+
+    # A stale receptor.pdbqt must not count as success
+    if os.path.exists(output_pdbqt):
+        os.remove(output_pdbqt)
+
+    # The same PDB prepared before (in any project) is linked from the store
+    cached, stderr = receptor_store.prepare(input_pdb, output_pdbqt, MGL_PYTHON, PREPARE_RECEPTOR)
+    if not os.path.exists(output_pdbqt):
+        return 1, f"Failed to create PDBQT. Stderr: {stderr}", None
+
+    ensemble = payload.get('ensemble') or []
+    if ensemble:
+        receptors = []
+        ensemble_cached = 0
+        for pdb, pdbqt in ensemble:
+            os.makedirs(os.path.dirname(pdbqt), exist_ok=True)
+            hit, stderr = receptor_store.prepare(pdb, pdbqt, MGL_PYTHON, PREPARE_RECEPTOR)
+            if not os.path.exists(pdbqt):
+                return 1, f"Failed to create PDBQT for {os.path.basename(pdb)}. Stderr: {stderr}", None
+            receptors.append(pdbqt)
+            ensemble_cached += hit
+        msg = f'{len(receptors)} receptors prepared for ensemble docking!'
+        if ensemble_cached: msg += f' Reused from cache: {ensemble_cached}.'
+        return 0, msg, {'receptor': output_pdbqt, 'receptors': receptors, 'cached': cached}
+
+    msg = 'Receptor prepared successfully!'
+    if cached: msg = 'Receptor reused from cache!'
+    return 0, msg, {'receptor': output_pdbqt, 'cached': cached}
+
+# --- BOX SIZE FROM LIGAND EXTENTS ---
+
+extent_cache = ExtentCache()
+
+def fitted_box(project_path, grid, params):
+    # Cube edge fitted to the project's prepared ligands (params 'box_fit'),
+    # kept at the Step 1 box center. Returns (edge, report), or (None, None)
+    # when there are no prepared ligands yet.
+    ligand_dir = os.path.join(project_path, 'ligand')
+    rg, extent = extent_cache.get(os.path.join(ligand_dir, 'pdbqt'), os.path.join(ligand_dir, LIBRARY_NAME))
+    if len(rg) == 0:
+        return None, None
+    edge = fit_box_edge(rg, extent, params['box_fit'], params.get('box_padding') or 2.0)
+    grid_size = [float(grid[key]) for key in ('size_x', 'size_y', 'size_z')]
+    return edge, {
+        'ligands': int(len(rg)),
+        'max_radius_of_gyration': round(float(rg.max()), 3),
+        'max_extent': round(float(extent.max()), 3),
+        'grid_box': box_estimate(grid_size),
+        'fitted_box': box_estimate([edge] * 3, reference=grid_size)
+    }
+
+def box_message(report):
+    fitted = report['fitted_box']
+    return (f"Box fitted to {report['ligands']} ligands: {fitted['size'][0]:.1f} A cube, "
+            f"{fitted['volume']:,.0f} A^3 ({fitted['relative_cost']:.2f}x the search volume of the Step 1 box).")
+
+@app.route('/box-estimate')
+def box_estimate_route():
+    # Volume and cost of the Step 1 box and, with box_fit set in the
+    # docking parameters, of the box fitted to the ligands
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project.'}), 400
     try:
-        # Run process
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        print("STDOUT:", result.stdout)
-        print("STDERR:", result.stderr)
+        with open(os.path.join(project_path, 'params', 'grid.json')) as f:
+            grid = json.load(f)
+    except FileNotFoundError:
+        return jsonify({'error': 'No grid saved yet. Please complete Step 1.'}), 404
+    params = {'box_fit': request.args.get('method', 'gyration'), 'box_padding': request.args.get('padding', type=float)}
+    if params['box_fit'] not in BOX_FIT_METHODS:
+        return jsonify({'error': f"method must be one of {', '.join(BOX_FIT_METHODS)}"}), 400
 
-        if os.path.exists(output_pdbqt):
-            return jsonify({'message': 'Receptor prepared successfully!'})
-        else:
-            return jsonify({'error': f"Failed to create PDBQT. Stderr: {result.stderr}"}), 500
+    edge, report = fitted_box(project_path, grid, params)
+    if edge is None:
+        return jsonify({'grid_box': box_estimate([float(grid[key]) for key in ('size_x', 'size_y', 'size_z')])})
+    return jsonify(report)
 
-    except Exception as e:
-        print(f"EXCEPTION: {e}")
-        return jsonify({'error': str(e)}), 500
-    
 # --- FIXED UPLOAD PARAMS ---
 # In app.py, replace the 'upload_params' route with this:
 
@@ -311,12 +455,45 @@ def upload_params():
             # 1. Capture Exhaustiveness
             'exhaustiveness': request.form.get('exhaustiveness'), 
             'num_modes': request.form.get('num_modes'),
+            # Concurrent docking processes; cores are split between them
+            'max_workers': int(request.form.get('max_workers') or 1),
+            # Ligands per unidock call (GPU only)
+            'batch_size': int(request.form.get('batch_size') or 1),
+            # Build receptor grid maps once and reuse them for every ligand (CPU only)
+            'precompute_maps': request.form.get('precompute_maps') == 'true',
+            # Keep poses only in results.sqlite instead of one *_out.pdbqt per ligand
+            'pack_poses': request.form.get('pack_poses') == 'true',
+            # Failed ligands are retried with a new seed; without a fixed
+            # timeout the runner allows 10x the median ligand time
+            'retries': int(request.form.get('retries') or 0),
+            'ligand_timeout': float(request.form['ligand_timeout']) if request.form.get('ligand_timeout') else None,
+            # Pre-docking filter; rejected ligands are reported in the CSV
+            'dedup': request.form.get('dedup') == 'true',
+            'check_box_fit': request.form.get('check_box_fit') == 'true',
+            'max_mw': float(request.form['max_mw']) if request.form.get('max_mw') else None,
+            'max_rotatable': int(request.form['max_rotatable']) if request.form.get('max_rotatable') else None,
+            # Fast pre-screen of every ligand, then re-dock the top X% and/or
+            # those at or below the cutoff with the settings above
+            'two_stage': request.form.get('two_stage') == 'true',
+            # A blank percentage means the runner's default, 10%
+            'refine_top_percent': float(request.form.get('refine_top_percent') or 10),
+            'refine_cutoff': float(request.form['refine_cutoff']) if request.form.get('refine_cutoff') else None,
+            # Cube box sized from the prepared ligands ('gyration' or 'extent'),
+            # centered where Step 1 put the box
+            'box_fit': request.form.get('box_fit') if request.form.get('box_fit') in BOX_FIT_METHODS else None,
+            'box_padding': float(request.form.get('box_padding') or 2.0),
+            # Dock into the top K pockets found in Step 1 instead of the box
+            'pocket_count': int(request.form.get('pocket_count') or 0),
+            # 'python' docks in long-lived workers through the Vina bindings
+            'engine': 'python' if request.form.get('use_bindings') == 'true' else 'subprocess',
             # 2. Check for 'use_gpu' string 'true' (sent from uploads.js)
             'use_gpu': request.form.get('use_gpu') == 'true' 
         }
 
         if not data['search_mode'] or not data['scoring_method'] or not data['num_modes']:
             return jsonify({'error': 'Missing required form fields.'}), 400
+        if data['two_stage'] and data['refine_top_percent'] <= 0 and data['refine_cutoff'] is None:
+            return jsonify({'error': 'Two-stage screening needs a top percentage above 0 or a score cutoff.'}), 400
 
         upload_folder = os.path.join(project_path, 'params')
         os.makedirs(upload_folder, exist_ok=True)
@@ -326,7 +503,18 @@ def upload_params():
         with open(file_path, 'w') as f:
             json.dump(data, f, indent=4)
 
-        return jsonify({'message': 'Parameters saved as JSON successfully.'}), 200
+        # Report the fitted box before the run, if ligands and grid are ready
+        message = 'Parameters saved as JSON successfully.'
+        response = {}
+        grid_path = os.path.join(upload_folder, 'grid.json')
+        if data['box_fit'] and os.path.exists(grid_path):
+            with open(grid_path) as f:
+                edge, report = fitted_box(project_path, json.load(f), data)
+            if edge is not None:
+                message += ' ' + box_message(report)
+                response['box'] = report
+
+        return jsonify({'message': message, **response}), 200
     except Exception as e:
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
@@ -336,7 +524,7 @@ def run_docking():
     if not project_path:
         return jsonify({'error': 'No active project found.'}), 400
 
-    if project_path in running_processes and running_processes[project_path].poll() is None:
+    if job_queue.active(project_path, 'docking'):
         return jsonify({'error': 'A docking process is already running for this project.'}), 409
 
     try:
@@ -370,25 +558,67 @@ def run_docking():
             **docking_params
         }
 
+        # Box sized from the ligands being docked, at the Step 1 center
+        box_report = None
+        if docking_params.get('box_fit'):
+            edge, box_report = fitted_box(project_path, grid_config, docking_params)
+            if edge is None:
+                return jsonify({'error': 'No prepared ligands to size the box from. Please re-run Step 2.'}), 400
+            master_config.update(size_x=edge, size_y=edge, size_z=edge)
+
+        # Top pockets from the blind grid, each docked as its own box
+        if docking_params.get('pocket_count'):
+            try:
+                with open(os.path.join(params_dir, 'pockets.json')) as f:
+                    pockets = json.load(f)[:int(docking_params['pocket_count'])]
+            except FileNotFoundError:
+                pockets = []
+            if not pockets:
+                return jsonify({'error': 'No pockets found for this receptor. Please re-run Step 1 or dock the whole box.'}), 400
+            if box_report:
+                # Fitted cubes, one per pocket center
+                pockets = [{**pocket, 'size_x': edge, 'size_y': edge, 'size_z': edge} for pocket in pockets]
+            master_config['pockets'] = pockets
+
+        # Ensemble: dock against every receptor prepared in Step 1
+        ensemble = sorted(glob.glob(os.path.join(receptor_dir, ENSEMBLE_DIR, '*.pdbqt')))
+        if len(ensemble) > 1:
+            master_config['receptors'] = [os.path.abspath(path) for path in ensemble]
+
+        # A streamed library takes the place of the per-molecule folder
+        library_path = os.path.join(ligand_dir, LIBRARY_NAME)
+        if os.path.exists(library_path):
+            master_config['ligand_library'] = os.path.abspath(library_path)
+
+        # Allow the caller to override the worker count for this run only
+        run_options = request.get_json(silent=True) or {}
+        if run_options.get('max_workers'):
+            master_config['max_workers'] = int(run_options['max_workers'])
+        # Resume skips ligands already recorded in results/checkpoint.jsonl
+        master_config['resume'] = bool(run_options.get('resume', False))
+        # Grid maps are cached by receptor hash, box and scoring function
+        master_config['maps_cache_dir'] = os.path.abspath(app.config['MAPS_CACHE'])
+        # Machine-readable per-ligand timings and the run summary
+        master_config['events_path'] = os.path.abspath(os.path.join(results_dir, 'docking_events.jsonl'))
+
         master_config_path = os.path.join(project_path, 'config.json')
         with open(master_config_path, 'w') as f:
             json.dump(master_config, f, indent=4)
         
-        script_path = os.path.join(os.path.dirname(__file__), 'unidock_multi.py')
-        # Force the script to run inside the 'vina' conda environment
-        # NEW (Faster, no buffering)
- 
-        command = [sys.executable, '-u', script_path, master_config_path]
-        
         log_file_path = os.path.join(results_dir, 'docking_run.log')
-        # buffering=1 forces the file to write to disk after every new line
-        log_file = open(log_file_path, 'w', buffering=1) 
-        
-        # We also pass bufsize=1 to Popen to be doubly sure
-        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, bufsize=1)
-        running_processes[project_path] = process
-
-        return jsonify({'message': f'Docking process started using {tool.upper()}!'}), 200
+        job_id = job_queue.submit(project_path, 'docking', {
+            'config_path': master_config_path,
+            'log_path': log_file_path,
+            'results_dir': os.path.abspath(results_dir)
+        }, exclusive=True)
+        # Another request may have queued a run since the check above
+        if job_id is None:
+            return jsonify({'error': 'A docking process is already running for this project.'}), 409
+
+        if box_report:
+            return jsonify({'message': f'Docking process queued using {tool.upper()}! {box_message(box_report)}',
+                            'job_id': job_id, 'box': box_report}), 200
+        return jsonify({'message': f'Docking process queued using {tool.upper()}!', 'job_id': job_id}), 200
 
     except FileNotFoundError as e:
         return jsonify({'error': f'A required configuration file is missing: {e.filename}'}), 500
@@ -396,56 +626,145 @@ def run_docking():
         app.logger.error(f"Error starting docking process: {e}")
         return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
 
+def run_docking_job(payload):
+    script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'unidock_multi.py')
+    cpu = max(1, (os.cpu_count() or 1) // app.config['DOCKING_JOBS'])
+    command = [sys.executable, '-u', script_path, payload['config_path'], '--cpu', str(cpu)]
+
+    # A run interrupted by a server restart continues from its checkpoint
+    resumed = payload.get('restarted', False)
+    if resumed:
+        command.append('--resume')
+
+    # buffering=1 forces the file to write to disk after every new line
+    with open(payload['log_path'], 'a' if resumed else 'w', buffering=1) as log_file:
+        # A runner started before a server restart keeps running (and holds
+        # the results dir lock); let it finish, then resume after it
+        os.makedirs(payload['results_dir'], exist_ok=True)
+        previous = lock_results_dir(payload['results_dir'])
+        if previous is None:
+            log_file.write(f"Waiting for the previous run (PID {lock_holder(payload['results_dir'])}) to finish...\n")
+            previous = lock_results_dir(payload['results_dir'], wait=True)
+        previous.close()
+
+        # We also pass bufsize=1 to Popen to be doubly sure
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, bufsize=1)
+        return_code = process.wait()
+
+    if return_code == 0:
+        return 0, 'Docking run finished successfully!', {'results_path': payload['results_dir']}
+    return return_code, f'Docking run failed with exit code {return_code}.', None
+
+job_queue = JobQueue(app.config['JOB_DB'], app.config['JOB_WORKERS'] + app.config['DOCKING_JOBS'],
+                     limits={'docking': app.config['DOCKING_JOBS']})
+job_queue.register('ligand_prep', run_ligand_prep)
+job_queue.register('receptor_prep', run_receptor_prep)
+job_queue.register('docking', run_docking_job)
+job_queue.start()
+
+def job_response(job):
+    return {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'message': job['message'],
+        'exit_code': job['exit_code'],
+        'created': job['created'],
+        'started': job['started'],
+        'finished': job['finished'],
+        'elapsed': job.get('elapsed'),
+        'result': job['result']
+    }
+
+@app.route('/job-status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found.'}), 404
+    return jsonify(job_response(job))
+
+progress_tracker = ProgressTracker()
+
+def find_docking_job(project_path):
+    job_id = request.args.get('job_id')
+    return job_queue.get(job_id) if job_id else job_queue.latest(project_path, 'docking')
+
 @app.route('/run-status', methods=['GET'])
 def run_status():
     project_path = session.get('project_path')
     if not project_path:
         return jsonify({'error': 'No active project found.'}), 400
 
-    if project_path not in running_processes:
+    job = find_docking_job(project_path)
+    if not job:
         return jsonify({'status': 'not_found', 'message': 'No active run found for this project.'})
 
-    process = running_processes[project_path]
-    return_code = process.poll()
+    # ?since=<byte offset> returns only the log written after that offset;
+    # the response's 'offset' is the value to send on the next poll.
+    since = request.args.get('since', 0, type=int)
 
-    results_dir = os.path.join(project_path, 'results')
-    log_file_path = os.path.join(results_dir, 'docking_run.log')
-    log_content = ""
-    try:
-        with open(log_file_path, 'r') as f:
-            log_content = f.read()
-    except FileNotFoundError:
-        log_content = "Log file has not been created yet..."
+    response = job_response(job)
+    if job['status'] == QUEUED:
+        response.update({'log': "Waiting for a free worker...", 'offset': since})
+        return jsonify(response)
 
-    if return_code is None:
-        return jsonify({
-            'status': 'running',
-            'log': log_content
-        })
+    log_path = job['payload']['log_path']
+    if os.path.exists(log_path):
+        log_content, offset, reset = read_log_chunk(log_path, since)
+        response.update({'log': log_content, 'offset': offset, 'reset': reset})
+        response['progress'] = progress_tracker.update(log_path, job['started'])
     else:
-        del running_processes[project_path]
-        
-        if return_code == 0:
-            results_path = os.path.abspath(results_dir)
-            return jsonify({
-                'status': 'completed', 
-                'message': 'Docking run finished successfully!',
-                'log': log_content,
-                'results_path': results_path 
-            })
-        else:
-            return jsonify({
-                'status': 'error', 
-                'message': f'Docking run failed with exit code {return_code}.',
-                'log': log_content
-            })
+        response.update({'log': "Log file has not been created yet...", 'offset': 0})
+
+    if job['result'] and 'results_path' in job['result']:
+        response['results_path'] = job['result']['results_path']
+
+    return jsonify(response)
+
+@app.route('/run-stream', methods=['GET'])
+def run_stream():
+    # Server-Sent Events: 'log' events carry new log text, 'progress' events
+    # the structured counters, and a final 'status' event ends the stream.
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    job = find_docking_job(project_path)
+    if not job:
+        return jsonify({'status': 'not_found', 'message': 'No active run found for this project.'}), 404
+
+    job_id = job['id']
+    since = request.args.get('since', 0, type=int)
+
+    def sse(event, data):
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def generate():
+        offset = since
+        while True:
+            job = job_queue.get(job_id)
+            log_path = job['payload']['log_path']
+            if job['status'] != QUEUED and os.path.exists(log_path):
+                text, offset, reset = read_log_chunk(log_path, offset)
+                if text or reset:
+                    yield sse('log', {'text': text, 'offset': offset, 'reset': reset})
+                yield sse('progress', progress_tracker.update(log_path, job['started']))
+
+            if job['status'] not in (QUEUED, RUNNING):
+                yield sse('status', job_response(job))
+                return
+            time.sleep(0.5)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/get_pdb', methods=['GET'])
 def get_pdb():
     filepath = request.args.get('filepath')
     if not filepath or not os.path.exists(filepath):
         return jsonify({'error': 'File not found.'}), 404
-    return send_file(filepath, mimetype='chemical/x-pdb')
+    # Content-hash ETag lets the browser revalidate instead of re-downloading
+    return send_file(filepath, mimetype='chemical/x-pdb', etag=receptor_cache.content_hash(filepath))
 
 @app.route('/get-project-path')
 def get_project_path():
@@ -463,10 +782,37 @@ def download_results():
     results_dir = os.path.join(project_path, 'results')
     if not os.path.exists(results_dir): return abort(404)
 
-    # Create a zip of the results directory
-    shutil.make_archive(os.path.join(project_path, 'docking_results'), 'zip', results_dir)
-    
-    return send_file(os.path.join(project_path, 'docking_results.zip'), as_attachment=True)
+    # Optional subset: ?top=N, ?max_affinity=-8.5, ?pattern=CHEMBL* (any mix)
+    top = request.args.get('top', type=int)
+    if top is not None:
+        top = max(top, 1)
+    max_affinity = request.args.get('max_affinity', type=float)
+    pattern = request.args.get('pattern')
+    cache = MemberCache(os.path.join(project_path, 'archive_cache'))
+
+    if top is None and max_affinity is None and not pattern:
+        members = results_members(results_dir, cache)
+        filename = 'docking_results.zip'
+    else:
+        table = results_tables.get(results_dir)
+        if table is None:
+            return jsonify({'error': 'CSV file not found. Run docking first.'}), 404
+        indices = table.select('affinity', max_affinity=max_affinity, pattern=pattern, failed=False)[:top]
+        members = selected_results(project_path, results_dir, table.rows(indices), table.header)
+        filename = 'docking_results_selected.zip'
+
+    # Streamed with chunked transfer; unchanged files reuse their cached
+    # compressed data, so nothing is written to a shared archive file
+    return Response(stream_with_context(zip_stream(members, cache)), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def selected_results(project_path, results_dir, rows, header):
+    store = open_results_store(project_path)
+    try:
+        yield from selected_members(results_dir, rows, header, store)
+    finally:
+        if store is not None:
+            store.close()
 
 # Add this route to app.py
 
@@ -483,6 +829,102 @@ def download_csv():
 
     return send_file(csv_path, as_attachment=True)
 
+# --- RESULTS QUERIES ---
+
+results_tables = ResultsTableCache()
+
+@app.route('/results')
+def query_results():
+    # Ranked, filtered, paginated view of docking_scores.csv:
+    # ?sort=affinity|-affinity|name|-name&max_affinity=&min_affinity=
+    #  &pattern=GLOB&failed=false&page=1&per_page=100&bins=20
+    project_path = session.get('project_path')
+    if not project_path: return jsonify({'error': 'No active project.'}), 400
+
+    table = results_tables.get(os.path.join(project_path, 'results'))
+    if table is None:
+        return jsonify({'error': 'No docking results yet. Run docking first.'}), 404
+
+    sort = request.args.get('sort', 'affinity')
+    if sort not in SORT_KEYS:
+        return jsonify({'error': f'sort must be one of {", ".join(SORT_KEYS)}.'}), 400
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 100, type=int), 1), 1000)
+    bins = min(max(request.args.get('bins', 20, type=int), 1), 200)
+
+    indices = table.select(
+        sort,
+        max_affinity=request.args.get('max_affinity', type=float),
+        min_affinity=request.args.get('min_affinity', type=float),
+        pattern=request.args.get('pattern'),
+        failed=request.args.get('failed', 'true') != 'false'
+    )
+    page_indices = indices[(page - 1) * per_page:page * per_page]
+
+    return jsonify({
+        'columns': table.header,
+        'rows': table.rows(page_indices),
+        'page': page,
+        'per_page': per_page,
+        'total': int(len(indices)),
+        'pages': -(-len(indices) // per_page),
+        'summary': table.summary(indices),
+        'histogram': table.histogram(indices, bins)
+    })
+
+# --- PACKED RESULTS STORE ---
+
+def open_results_store(project_path):
+    store_path = os.path.join(project_path, 'results', STORE_NAME)
+    if not os.path.exists(store_path):
+        return None
+    return ResultsStore(store_path)
+
+@app.route('/top-ligands')
+def top_ligands():
+    project_path = session.get('project_path')
+    if not project_path: return jsonify({'error': 'No active project.'}), 400
+
+    # An invalid k falls back to the default; LIMIT is kept to 1..1000
+    k = min(max(request.args.get('k', 10, type=int), 1), 1000)
+
+    store = open_results_store(project_path)
+    if store is None:
+        return jsonify({'error': 'No docking results yet. Run docking first.'}), 404
+    try:
+        rows = store.top(k)
+    finally:
+        store.close()
+    return jsonify({'ligands': [{'ligand': name, 'affinity': affinity, 'rmsd_lb': rmsd_lb}
+                                for name, affinity, rmsd_lb in rows]})
+
+@app.route('/pose/<path:ligand>')
+def export_pose(ligand):
+    # Poses are rebuilt from the store on demand: ?format=pdbqt|sdf&modes=N
+    project_path = session.get('project_path')
+    if not project_path: return jsonify({'error': 'No active project.'}), 400
+
+    fmt = request.args.get('format', 'pdbqt')
+    if fmt not in ('pdbqt', 'sdf'):
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    modes = request.args.get('modes', type=int)
+
+    store = open_results_store(project_path)
+    if store is None:
+        return jsonify({'error': 'No docking results yet. Run docking first.'}), 404
+    try:
+        text = store.export_sdf(ligand, modes) if fmt == 'sdf' else store.export_pdbqt(ligand, modes)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        store.close()
+    if text is None:
+        return jsonify({'error': f'No poses stored for {ligand}.'}), 404
+
+    base_name = os.path.splitext(ligand)[0]
+    return Response(text, mimetype='chemical/x-mdl-sdfile' if fmt == 'sdf' else 'chemical/x-pdbqt',
+                    headers={'Content-Disposition': f'attachment; filename={base_name}_out.{fmt}'})
+
 def open_browser():
     webbrowser.open_new("http://127.0.0.1:5000/")
 
@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import zlib
+import random
+import hashlib
+
+# Stand-ins for obabel, vina and unidock (see bench/bin). They take the
+# arguments the app and the runner pass, write the files the real programs
+# write and print the same tables, after a configurable delay:
+#   BENCH_DOCK_SECONDS     vina time per ligand (default 0.05)
+#   BENCH_DOCK_PER_ATOM    extra vina time per ligand atom (default 0)
+#   BENCH_PREP_SECONDS     obabel time per molecule (default 0.01)
+#   BENCH_MAPS_SECONDS     vina --write_maps time (default 0.2)
+#   BENCH_UNIDOCK_STARTUP  unidock time per process (default 0.5)
+#   BENCH_BATCH_FACTOR     unidock time per ligand, as a fraction of
+#                          BENCH_DOCK_SECONDS (default 0.2)
+#   BENCH_FAIL_RATE        fraction of ligands that fail (default 0)
+# Only the standard library is used, so start-up time stays close to the
+# real programs'.
+
+def setting(name, default):
+    return float(os.environ.get(name) or default)
+
+def parse_args(argv, flags=()):
+    # --key value pairs; keys in flags take no value
+    args = {}
+    i = 0
+    while i < len(argv):
+        key = argv[i].lstrip('-')
+        if key in flags or i + 1 == len(argv):
+            args[key] = True
+            i += 1
+        else:
+            args[key] = argv[i + 1]
+            i += 2
+    return args
+
+def pdbqt_text(name, coords, torsions):
+    lines = [f"REMARK  Name = {name}\n", "ROOT\n"]
+    for i, (x, y, z) in enumerate(coords, start=1):
+        ad_type = 'OA' if i % 7 == 0 else 'N' if i % 11 == 0 else 'C'
+        lines.append(f"ATOM  {i:5d} {ad_type[0] + str(i):<4} UNL  {1:4d}    {x:8.3f}{y:8.3f}{z:8.3f}"
+                     f"{0:6.2f}{0:6.2f}    {0:6.3f} {ad_type:<2}\n")
+    lines.append("ENDROOT\n")
+    lines.append(f"TORSDOF {torsions}\n")
+    return ''.join(lines)
+
+def ligand_atoms(path):
+    with open(path) as f:
+        return sum(line.startswith(('ATOM', 'HETATM')) for line in f)
+
+def fails(name, seed):
+    # Deterministic per ligand and seed, so a retry with a new seed can pass
+    key = zlib.crc32(f"{name}:{seed}".encode()) / 0xffffffff
+    return key < setting('BENCH_FAIL_RATE', 0)
+
+def mode_scores(name, num_modes):
+    # Reproducible poses per ligand name, best first
+    rng = random.Random(zlib.crc32(name.encode()))
+    best = -rng.uniform(5.0, 11.0)
+    return [(round(best + 0.3 * i, 3), 0.0 if i == 0 else round(rng.uniform(1.0, 8.0), 3),
+             0.0 if i == 0 else round(rng.uniform(2.0, 12.0), 3)) for i in range(num_modes)]
+
+def write_poses(out_path, ligand_path, scores):
+    with open(ligand_path) as f:
+        ligand = [line for line in f if not line.startswith('REMARK')]
+    with open(out_path, 'w') as f:
+        for mode, (affinity, rmsd_lb, rmsd_ub) in enumerate(scores, start=1):
+            f.write(f"MODEL {mode}\n")
+            f.write(f"REMARK VINA RESULT: {affinity:8.3f}{rmsd_lb:11.3f}{rmsd_ub:11.3f}\n")
+            f.writelines(ligand)
+            f.write("ENDMDL\n")
+
+def score_table(scores):
+    lines = ["mode |   affinity | dist from best mode",
+             "     | (kcal/mol) | rmsd l.b.| rmsd u.b.",
+             "-----+------------+----------+----------"]
+    for mode, (affinity, rmsd_lb, rmsd_ub) in enumerate(scores, start=1):
+        lines.append(f"{mode:4d}   {affinity:10.1f}{rmsd_lb:11.3f}{rmsd_ub:11.3f}")
+    return "\n".join(lines)
+
+# --- VINA ---
+
+def vina_main(argv):
+    args = parse_args(argv, flags=('force_even_voxels',))
+    if 'write_maps' in args:
+        time.sleep(setting('BENCH_MAPS_SECONDS', 0.2))
+        for kind in ('C', 'N', 'OA', 'e', 'd'):
+            with open(f"{args['write_maps']}.{kind}.map", 'w') as f:
+                f.write("GRID_PARAMETER_FILE receptor.gpf\nSPACING 0.375\n")
+        print("Computing Vina grid ... done.")
+        return 0
+
+    ligand = args.get('ligand')
+    if not ligand or not os.path.exists(ligand):
+        print(f"ERROR: Could not open \"{ligand}\" for reading.", file=sys.stderr)
+        return 1
+    name = os.path.splitext(os.path.basename(ligand))[0]
+
+    time.sleep(setting('BENCH_DOCK_SECONDS', 0.05) + setting('BENCH_DOCK_PER_ATOM', 0) * ligand_atoms(ligand))
+    if fails(name, args.get('seed')):
+        print("Parse error: ligand could not be docked", file=sys.stderr)
+        return 1
+
+    scores = mode_scores(name, int(args.get('num_modes', 9)))
+    write_poses(args.get('out') or os.path.splitext(ligand)[0] + '_out.pdbqt', ligand, scores)
+    print("AutoDock Vina (benchmark stub)")
+    print("Performing docking (random seed: 0) ... done.")
+    print(score_table(scores))
+    return 0
+
+# --- UNIDOCK ---
+
+def unidock_main(argv):
+    args = parse_args(argv)
+    if 'ligand_index' in args:
+        with open(args['ligand_index']) as f:
+            ligands = f.read().split()
+    else:
+        ligands = [args['ligand']]
+    out_dir = args.get('dir', '.')
+    num_modes = int(args.get('num_modes', 9))
+
+    time.sleep(setting('BENCH_UNIDOCK_STARTUP', 0.5)
+               + len(ligands) * setting('BENCH_DOCK_SECONDS', 0.05) * setting('BENCH_BATCH_FACTOR', 0.2))
+    print(f"Uni-Dock (benchmark stub): {len(ligands)} ligands")
+    for ligand in ligands:
+        name = os.path.splitext(os.path.basename(ligand))[0]
+        # A failed ligand is left without an output file, as unidock does
+        if fails(name, args.get('seed')):
+            continue
+        write_poses(os.path.join(out_dir, name + '_out.pdbqt'), ligand, mode_scores(name, num_modes))
+    return 0
+
+# --- OBABEL ---
+
+def molecule_coords(text):
+    # Coordinates from an SDF/MOL record; other formats get a random walk
+    # seeded by the record, about the size of a drug-like molecule
+    lines = text.splitlines()
+    if len(lines) > 3 and lines[3].rstrip().endswith('V2000'):
+        n = int(lines[3][:3])
+        return [(float(line[0:10]), float(line[10:20]), float(line[20:30])) for line in lines[4:4 + n]]
+    rng = random.Random(zlib.crc32(text.encode()))
+    coords = [(0.0, 0.0, 0.0)]
+    for _ in range(rng.randint(10, 40) - 1):
+        step = [rng.gauss(0, 1) for _ in range(3)]
+        norm = sum(v * v for v in step) ** 0.5 or 1.0
+        coords.append(tuple(c + 1.5 * v / norm for c, v in zip(coords[-1], step)))
+    return coords
+
+def obabel_main(argv):
+    # obabel -ipdbqt -ocan -r < ligand.pdbqt: one canonical string per
+    # molecule, the same for identical atoms
+    if '-ocan' in argv:
+        data = sys.stdin.read()
+        atoms = sorted(line[12:54] for line in data.splitlines() if line.startswith(('ATOM', 'HETATM')))
+        if not atoms:
+            print("0 molecules converted", file=sys.stderr)
+            return 1
+        print(f"C{len(atoms)}.{hashlib.sha256(''.join(atoms).encode()).hexdigest()[:16]}\tligand")
+        print("1 molecule converted", file=sys.stderr)
+        return 0
+
+    # obabel input.sdf -O output.pdbqt [options]
+    input_path, output_path = argv[0], argv[argv.index('-O') + 1]
+    with open(input_path, errors='replace') as f:
+        text = f.read()
+    time.sleep(setting('BENCH_PREP_SECONDS', 0.01))
+    coords = molecule_coords(text)
+    name = text.splitlines()[0].strip() if text.strip() else 'ligand'
+    with open(output_path, 'w') as f:
+        f.write(pdbqt_text(name, coords, min(len(coords) // 4, 12)))
+    print("1 molecule converted", file=sys.stderr)
+    return 0
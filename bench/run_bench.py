@@ -0,0 +1,374 @@
+import os
+import sys
+import io
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import synth
+
+# Throughput and latency of the docking pipeline on a CPU-only machine.
+# The stub programs in bench/bin stand in for obabel, vina and unidock
+# (latency settings in bench/fakes.py), so every number here is the cost
+# of this code around them:
+#   runner      unidock_multi.py ligands/sec and scheduler overhead
+#   ligprep     /lig_upload ligands/sec, per-file and library mode
+#   grid        /grid latency against receptor atom count
+#   status      /run-status cost against docking log size
+#
+#   python bench/run_bench.py                   everything, full sizes
+#   python bench/run_bench.py --quick           smaller sizes, about a minute
+#   python bench/run_bench.py runner --json out.json
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BIN_DIR = os.path.join(BENCH_DIR, 'bin')
+SUITES = ('runner', 'ligprep', 'grid', 'status')
+
+def median_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+def print_table(title, header, rows):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    print(f"\n{title}")
+    print("  ".join(str(cell).rjust(width) for cell, width in zip(header, widths)))
+    print("  ".join('-' * width for width in widths))
+    for row in rows:
+        print("  ".join(str(cell).rjust(width) for cell, width in zip(row, widths)))
+
+# --- RUNNER ---
+
+def runner_config(work_dir, name, **settings):
+    results_dir = os.path.join(work_dir, name)
+    shutil.rmtree(results_dir, ignore_errors=True)
+    return {
+        'receptor': os.path.join(work_dir, 'receptor.pdbqt'),
+        'ligand_dir': os.path.join(work_dir, 'ligands'),
+        'results_dir': results_dir,
+        'vina_path': os.path.join(BIN_DIR, 'vina'),
+        'center_x': 0.0, 'center_y': 0.0, 'center_z': 0.0,
+        'size_x': 20.0, 'size_y': 20.0, 'size_z': 20.0,
+        'exhaustiveness': 8,
+        'num_modes': 9,
+        'retries': 0,
+        'events_path': os.path.join(work_dir, name + '_events.jsonl'),
+        **settings
+    }
+
+def run_runner(config):
+    # Returns (process wall time, run_summary event, ligand_end events)
+    config_path = config['events_path'].replace('_events.jsonl', '.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'unidock_multi.py'), config_path],
+                            capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"unidock_multi.py failed:\n{result.stdout}\n{result.stderr}")
+
+    with open(config['events_path']) as f:
+        records = [json.loads(line) for line in f]
+    summary = next(record for record in records if record['event'] == 'run_summary')
+    return wall, summary, [record for record in records if record['event'] == 'ligand_end']
+
+def bench_runner(work_dir, n_ligands, workers, latency):
+    # Vina per ligand at several worker counts, then Uni-Dock batches. The
+    # ideal time is the stub latency alone, perfectly packed onto the
+    # workers; overhead is the worker time per ligand spent on anything else.
+    work_dir = os.path.join(work_dir, 'runner')
+    synth.write_ligand_pdbqts(os.path.join(work_dir, 'ligands'), n_ligands)
+    synth.write_receptor_pdb(os.path.join(work_dir, 'receptor.pdbqt'), 2000)
+
+    rows = []
+    report = []
+    for n_workers in workers:
+        config = runner_config(work_dir, f"vina_w{n_workers}", tool='vina', max_workers=n_workers, cpu=n_workers)
+        wall, summary, ligands = run_runner(config)
+        ideal = math.ceil(n_ligands / n_workers) * latency
+        process_ms = (statistics.median(record['wall_time'] for record in ligands) - latency) * 1000
+        entry = {
+            'tool': 'vina', 'workers': n_workers, 'batch': 1, 'ligands': n_ligands,
+            'wall': round(wall, 3), 'run': summary['wall_time'], 'ideal': round(ideal, 3),
+            'ligands_per_sec': summary['ligands_per_sec'],
+            'efficiency': round(ideal / summary['wall_time'], 3),
+            'overhead_ms': round((summary['wall_time'] - ideal) * n_workers / n_ligands * 1000, 1),
+            'process_ms': round(process_ms, 1),
+            'startup': round(wall - summary['wall_time'], 3)
+        }
+        report.append(entry)
+
+    batch = 16
+    startup = float(os.environ['BENCH_UNIDOCK_STARTUP'])
+    per_ligand = latency * float(os.environ['BENCH_BATCH_FACTOR'])
+    config = runner_config(work_dir, 'unidock_b16', tool='unidock', max_workers=2, cpu=2, batch_size=batch)
+    wall, summary, ligands = run_runner(config)
+    batches = [min(batch, n_ligands - start) for start in range(0, n_ligands, batch)]
+    ideal = sum(startup + size * per_ligand for size in batches) / min(2, len(batches))
+    report.append({
+        'tool': 'unidock', 'workers': 2, 'batch': batch, 'ligands': n_ligands,
+        'wall': round(wall, 3), 'run': summary['wall_time'], 'ideal': round(ideal, 3),
+        'ligands_per_sec': summary['ligands_per_sec'],
+        'efficiency': round(ideal / summary['wall_time'], 3),
+        'overhead_ms': round((summary['wall_time'] - ideal) * 2 / n_ligands * 1000, 1),
+        'process_ms': None,
+        'startup': round(wall - summary['wall_time'], 3)
+    })
+
+    for entry in report:
+        rows.append([entry['tool'], entry['workers'], entry['batch'], entry['ligands'], entry['run'],
+                     entry['ideal'], entry['ligands_per_sec'], f"{entry['efficiency']:.0%}",
+                     entry['overhead_ms'], '-' if entry['process_ms'] is None else entry['process_ms'],
+                     entry['startup']])
+    print_table(f"unidock_multi.py ({latency * 1000:.0f} ms per vina ligand)",
+                ['tool', 'workers', 'batch', 'ligands', 'run s', 'ideal s', 'lig/s', 'eff',
+                 'overhead ms/lig', 'process ms/lig', 'startup s'], rows)
+    return report
+
+# --- APP ---
+
+class AppClient:
+    # Flask test client on a fresh project, polling queued jobs to the end
+
+    def __init__(self, app_module, name):
+        self.app = app_module
+        self.client = app_module.app.test_client()
+        response = self.client.post('/create-project', json={'project_name': name})
+        if response.status_code != 200:
+            raise RuntimeError(response.get_json()['error'])
+        self.project = self.client.get('/get-project-path').get_json()['project_path']
+
+    def post(self, url, **kwargs):
+        response = self.client.post(url, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{url}: {response.get_json()}")
+        return response.get_json()
+
+    def wait(self, job_id):
+        while True:
+            job = self.client.get(f'/job-status/{job_id}').get_json()
+            if job['status'] not in ('queued', 'running'):
+                return job
+            time.sleep(0.02)
+
+def upload_files(inputs, library):
+    # multipart form for /lig_upload from {filename: bytes}
+    return {'files[]': [(io.BytesIO(data), name) for name, data in inputs.items()],
+            'library': 'true' if library else 'false'}
+
+def bench_ligprep(app_module, work_dir, n_ligands):
+    # Cold runs convert every molecule with the obabel stub; warm runs
+    # upload the same files again and relink from the shared cache.
+    # Prepared .pdbqt uploads skip obabel and must arrive unchanged.
+    rows = []
+    report = []
+    cases = (('sdf', False, 1), ('sdf', True, 2), ('pdbqt', False, 3), ('pdbqt', True, 4))
+    for fmt, library, seed in cases:
+        if fmt == 'sdf':
+            sdf_path = synth.write_ligand_sdf(os.path.join(work_dir, f'ligands_{seed}.sdf'), n_ligands, seed=seed)
+            with open(sdf_path, 'rb') as f:
+                inputs = {'ligands.sdf': f.read()}
+        else:
+            prepared_dir = synth.write_ligand_pdbqts(os.path.join(work_dir, f'prepared_{seed}'), n_ligands, seed=seed)
+            inputs = {}
+            for name in sorted(os.listdir(prepared_dir)):
+                with open(os.path.join(prepared_dir, name), 'rb') as f:
+                    inputs[name] = f.read()
+
+        client = AppClient(app_module, f"ligprep_{seed}")
+        for run in ('cold', 'warm'):
+            started = time.perf_counter()
+            job = client.post('/lig_upload', data=upload_files(inputs, library), content_type='multipart/form-data')
+            job = client.wait(job['job_id'])
+            elapsed = time.perf_counter() - started
+            if job['status'] != 'completed' or job['result']['count'] != n_ligands:
+                raise RuntimeError(f"Ligand prep failed for {fmt} input: {job['message']}")
+            if fmt == 'pdbqt':
+                check_prepared(client.project, inputs, library)
+            entry = {'mode': 'library' if library else 'files', 'input': fmt, 'run': run, 'ligands': n_ligands,
+                     'seconds': round(elapsed, 3), 'ligands_per_sec': round(n_ligands / elapsed, 1)}
+            report.append(entry)
+            rows.append([entry['mode'], fmt, run, n_ligands, entry['seconds'], entry['ligands_per_sec']])
+    print_table(f"/lig_upload ({float(os.environ['BENCH_PREP_SECONDS']) * 1000:.0f} ms per obabel call, "
+                f"{app_module.app.config['LIGAND_PREP_WORKERS']} workers)",
+                ['mode', 'input', 'cache', 'ligands', 'seconds', 'lig/s'], rows)
+    return report
+
+def check_prepared(project, inputs, library):
+    # Every uploaded .pdbqt must reach the project byte for byte
+    from ligand_prep import LigandLibrary
+
+    ligand_dir = os.path.join(project, 'ligand')
+    if library:
+        prepared = {name + '.pdbqt': data
+                    for _, name, data in LigandLibrary(os.path.join(ligand_dir, 'library.pdbqt')).iter_range()}
+    else:
+        prepared = {}
+        for name in os.listdir(os.path.join(ligand_dir, 'pdbqt')):
+            with open(os.path.join(ligand_dir, 'pdbqt', name), 'rb') as f:
+                prepared[name] = f.read()
+    expected = {name: data if data.endswith(b'\n') else data + b'\n' for name, data in inputs.items()}
+    if prepared != expected:
+        raise RuntimeError(f"Prepared .pdbqt ligands were not kept as uploaded ({'library' if library else 'files'} mode)")
+
+def bench_grid(app_module, work_dir, atom_counts, repeat):
+    # First call parses the PDB (cold); later calls hit the receptor cache
+    client = AppClient(app_module, 'grid')
+    cases = {
+        'blind': {'mode': 'blind'},
+        'targeted r=8': {'mode': 'targeted', 'residues': ['A:10', 'A:11', 'A:12'], 'radius': 8},
+        'blind+pockets': {'mode': 'blind', 'pockets': True}
+    }
+    rows = []
+    report = []
+    for n_atoms in atom_counts:
+        pdb_path = synth.write_receptor_pdb(os.path.join(work_dir, f'receptor_{n_atoms}.pdb'), n_atoms)
+        with open(pdb_path, 'rb') as f:
+            filepath = client.post('/rec_upload', data={'file': (f, os.path.basename(pdb_path))},
+                                   content_type='multipart/form-data')['filepath']
+
+        cold = median_time(lambda: client.post('/grid', json={'filepath': filepath, **cases['blind']}), 1)
+        entry = {'atoms': n_atoms, 'cold_ms': round(cold * 1000, 1)}
+        for name, case in cases.items():
+            seconds = median_time(lambda: client.post('/grid', json={'filepath': filepath, **case}), repeat)
+            entry[name] = round(seconds * 1000, 1)
+        entry['pockets_found'] = len(client.post('/grid', json={'filepath': filepath, **cases['blind+pockets']})['pockets'])
+        report.append(entry)
+        rows.append([n_atoms, entry['cold_ms'], *(entry[name] for name in cases), entry['pockets_found']])
+    print_table("/grid latency (ms)", ['atoms', 'cold', *cases, 'pockets'], rows)
+    return report
+
+def bench_status(app_module, work_dir, log_sizes_mb, repeat):
+    # A short docking run through the app (Uni-Dock stub), then its log is
+    # grown to each size. A full poll (since=0) returns the whole log; an
+    # incremental poll only what was appended since the previous one.
+    client = AppClient(app_module, 'status')
+    project = client.project
+    pdb_path = synth.write_receptor_pdb(os.path.join(work_dir, 'receptor_status.pdb'), 2000)
+    with open(pdb_path, 'rb') as f:
+        client.post('/rec_upload', data={'file': (f, 'receptor.pdb')}, content_type='multipart/form-data')
+
+    # Receptor prep needs MGLTools, which is not stubbed: the PDB stands in
+    # for the prepared receptor and the grid is written as Step 1 would
+    os.makedirs(os.path.join(project, 'params'), exist_ok=True)
+    shutil.copyfile(pdb_path, os.path.join(project, 'receptor', 'receptor.pdbqt'))
+    with open(os.path.join(project, 'params', 'grid.json'), 'w') as f:
+        json.dump({'center_x': 0.0, 'center_y': 0.0, 'center_z': 0.0,
+                   'size_x': 20.0, 'size_y': 20.0, 'size_z': 20.0}, f)
+    synth.write_ligand_pdbqts(os.path.join(project, 'ligand', 'pdbqt'), 32)
+    client.post('/upload-params', data={'search_mode': 'Balanced', 'scoring_method': 'vina', 'exhaustiveness': '8',
+                                        'num_modes': '9', 'use_gpu': 'true', 'batch_size': '8', 'max_workers': '2'})
+
+    started = time.perf_counter()
+    client.post('/run-docking', json={})
+    while client.client.get('/run-status').get_json()['status'] in ('queued', 'running'):
+        time.sleep(0.02)
+    run_seconds = time.perf_counter() - started
+    status = client.client.get('/run-status?since=0').get_json()
+    if status['status'] != 'completed':
+        raise RuntimeError(f"Docking run failed:\n{status['log']}")
+    log_path = os.path.join(project, 'results', 'docking_run.log')
+
+    def poll(since):
+        response = client.client.get(f'/run-status?since={since}')
+        return response.get_json()['offset']
+
+    rows = []
+    report = []
+    ligand = 0
+    for size_mb in log_sizes_mb:
+        ligand = synth.append_run_log(log_path, size_mb * 1024 * 1024 - os.path.getsize(log_path), ligand)
+        # The first poll after a jump parses everything new for the progress tally
+        offset = os.path.getsize(log_path)
+        catch_up = median_time(lambda: poll(offset), 1)
+        full = median_time(lambda: poll(0), repeat)
+
+        def incremental():
+            nonlocal ligand, offset
+            size = os.path.getsize(log_path)
+            ligand = synth.append_run_log(log_path, 4096, ligand)
+            offset = poll(size)
+        step = median_time(incremental, repeat * 3)
+
+        entry = {'log_mb': size_mb, 'catch_up_ms': round(catch_up * 1000, 1),
+                 'full_ms': round(full * 1000, 1), 'incremental_ms': round(step * 1000, 2)}
+        report.append(entry)
+        rows.append([size_mb, entry['catch_up_ms'], entry['full_ms'], entry['incremental_ms']])
+    print_table(f"/run-status poll cost (ms; app docking run took {run_seconds:.2f} s)",
+                ['log MB', 'catch-up', 'since=0', '+4 KB since=offset'], rows)
+    return report
+
+# --- MAIN ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Docking pipeline benchmarks with stub docking programs")
+    parser.add_argument('suites', nargs='*', help=f"Benchmarks to run: {', '.join(SUITES)} (default: all)")
+    parser.add_argument('--quick', action='store_true', help="Smaller sizes, for a fast regression check")
+    parser.add_argument('--ligands', type=int, help="Ligands per runner and ligand prep run")
+    parser.add_argument('--workers', type=int, nargs='+', help="Runner worker counts")
+    parser.add_argument('--latency', type=float, default=0.05, help="Stub vina time per ligand, seconds")
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    parser.add_argument('--keep', action='store_true', help="Keep the working directory")
+    args = parser.parse_args()
+
+    suites = args.suites or SUITES
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+    n_ligands = args.ligands or (48 if args.quick else 256)
+    workers = args.workers or ([1, 4] if args.quick else [1, 2, 4, 8, 16])
+    atom_counts = [1000, 5000, 20000] if args.quick else [1000, 5000, 20000, 50000, 100000]
+    log_sizes_mb = [1, 5] if args.quick else [1, 10, 50]
+    repeat = 3 if args.quick else 5
+
+    # The stubs read their latency from the environment; the runner and
+    # the app find obabel and unidock on PATH
+    os.environ['BENCH_DOCK_SECONDS'] = str(args.latency)
+    os.environ.setdefault('BENCH_PREP_SECONDS', '0.01')
+    os.environ.setdefault('BENCH_UNIDOCK_STARTUP', '0.1')
+    os.environ.setdefault('BENCH_BATCH_FACTOR', '0.2')
+    os.environ['PATH'] = BIN_DIR + os.pathsep + os.environ.get('PATH', '')
+
+    work_dir = tempfile.mkdtemp(prefix='amr_dock_bench_')
+    print(f"Working directory: {work_dir}")
+    results = {'settings': {'ligands': n_ligands, 'latency': args.latency, 'quick': args.quick,
+                            'cpu_count': os.cpu_count()}}
+    cwd = os.getcwd()
+    try:
+        if 'runner' in suites:
+            results['runner'] = bench_runner(work_dir, n_ligands, workers, args.latency)
+
+        app_suites = [suite for suite in suites if suite != 'runner']
+        if app_suites:
+            # app.py keeps its workspace relative to the working directory
+            os.chdir(work_dir)
+            sys.path.insert(0, REPO_DIR)
+            import app as app_module
+            if 'ligprep' in suites:
+                results['ligprep'] = bench_ligprep(app_module, work_dir, n_ligands)
+            if 'grid' in suites:
+                results['grid'] = bench_grid(app_module, work_dir, atom_counts, repeat)
+            if 'status' in suites:
+                results['status'] = bench_status(app_module, work_dir, log_sizes_mb, repeat)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"\nResults written to {args.json}")
+
+if __name__ == "__main__":
+    main()
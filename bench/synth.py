@@ -0,0 +1,95 @@
+import os
+import math
+
+import numpy as np
+
+from fakes import pdbqt_text
+
+# Synthetic inputs of any size for the benchmarks: protein-like receptors
+# (a ball of atoms with a few carved-out pockets), ligand libraries as SDF
+# or prepared PDBQT, and runner-style logs.
+
+ATOM_NAMES = ('N', 'CA', 'C', 'O', 'CB', 'CG', 'CD', 'CE')
+# Heavy atoms per A^3 in a folded protein, roughly
+PROTEIN_DENSITY = 0.055
+
+# --- RECEPTORS ---
+
+def receptor_coords(n_atoms, seed=0, pockets=3, pocket_radius=5.0):
+    rng = np.random.default_rng(seed)
+    radius = (3 * n_atoms / (4 * math.pi * PROTEIN_DENSITY)) ** (1 / 3)
+    centers = rng.normal(size=(pockets, 3))
+    centers = centers / np.linalg.norm(centers, axis=1)[:, None] * radius * 0.6
+
+    coords = np.zeros((0, 3))
+    while len(coords) < n_atoms:
+        batch = rng.uniform(-radius, radius, size=(n_atoms, 3))
+        batch = batch[np.linalg.norm(batch, axis=1) <= radius]
+        for center in centers:
+            batch = batch[np.linalg.norm(batch - center, axis=1) > pocket_radius]
+        coords = np.concatenate([coords, batch])
+    return coords[:n_atoms]
+
+def write_receptor_pdb(path, n_atoms, seed=0, pockets=3):
+    # Eight atoms per residue, chains A, B, ... every 9999 residues
+    coords = receptor_coords(n_atoms, seed, pockets)
+    with open(path, 'w') as f:
+        for i, (x, y, z) in enumerate(coords):
+            residue = i // len(ATOM_NAMES)
+            chain = chr(ord('A') + residue // 9999 % 26)
+            name = ATOM_NAMES[i % len(ATOM_NAMES)]
+            f.write(f"ATOM  {i % 99999 + 1:5d}  {name:<3} ALA {chain}{residue % 9999 + 1:4d}    "
+                    f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00           {name[0]}\n")
+        f.write("END\n")
+    return path
+
+# --- LIGANDS ---
+
+def ligand_coords(rng, n_atoms):
+    # A random walk with 1.5 A steps, so sizes and radii of gyration are
+    # in the range of drug-like molecules
+    steps = rng.normal(size=(n_atoms, 3))
+    steps = steps / np.linalg.norm(steps, axis=1)[:, None] * 1.5
+    steps[0] = 0
+    return np.cumsum(steps, axis=0)
+
+def write_ligand_sdf(path, n_ligands, atoms=(10, 40), seed=0):
+    # One multi-molecule SDF (V2000, chain bonds), as uploaded to /lig_upload
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        for i in range(n_ligands):
+            coords = ligand_coords(rng, int(rng.integers(atoms[0], atoms[1] + 1)))
+            f.write(f"lig_{i + 1}\n  bench\n\n")
+            f.write(f"{len(coords):3d}{len(coords) - 1:3d}  0  0  0  0  0  0  0  0999 V2000\n")
+            for x, y, z in coords:
+                f.write(f"{x:10.4f}{y:10.4f}{z:10.4f} C   0  0  0  0  0  0  0  0  0  0  0  0\n")
+            for a in range(1, len(coords)):
+                f.write(f"{a:3d}{a + 1:3d}  1  0\n")
+            f.write("M  END\n$$$$\n")
+    return path
+
+def write_ligand_pdbqts(ligand_dir, n_ligands, atoms=(10, 40), seed=0):
+    # Prepared ligands for runner benchmarks, one .pdbqt each
+    os.makedirs(ligand_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(n_ligands):
+        coords = ligand_coords(rng, int(rng.integers(atoms[0], atoms[1] + 1)))
+        name = f"lig_{i + 1}"
+        with open(os.path.join(ligand_dir, name + '.pdbqt'), 'w') as f:
+            f.write(pdbqt_text(name, coords, int(rng.integers(0, 12))))
+    return ligand_dir
+
+# --- LOGS ---
+
+def append_run_log(path, n_bytes, start=0):
+    # Appends runner-style progress lines until the log has grown by about
+    # n_bytes; returns the number of the last ligand written
+    written = 0
+    i = start
+    with open(path, 'a') as f:
+        while written < n_bytes:
+            i += 1
+            chunk = f"Docking {i} of 1000000: lig_{i}.pdbqt...\n>>> lig_{i}.pdbqt docking done. (Affinity: -7.{i % 10})\n\n"
+            f.write(chunk)
+            written += len(chunk)
+    return i
@@ -0,0 +1,111 @@
+import os
+import math
+
+import numpy as np
+
+from ligand_prep import LigandLibrary
+
+# Box edge that fits a ligand best, as a multiple of its radius of gyration
+# (eBoxSize, Feinstein & Brylinski, J Cheminform 2015)
+RG_BOX_FACTOR = 2.857
+# Vina's default map spacing, for the grid point count
+GRID_SPACING = 0.375
+# Smallest fitted edge, so fragments still leave room to search
+MIN_BOX_EDGE = 10.0
+BOX_FIT_METHODS = ('gyration', 'extent')
+
+# --- LIGAND EXTENTS ---
+
+def ligand_extents(blobs):
+    # Radius of gyration and extent of every ligand from PDBQT bytes. The
+    # extent is twice the largest atom distance from the centroid, so the
+    # ligand fits in a cube of that edge in any orientation. All atoms go
+    # into one array and are reduced per ligand with reduceat.
+    fields = []
+    counts = []
+    for data in blobs:
+        n = 0
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            if line.startswith(('ATOM', 'HETATM')):
+                fields.append((line[30:38], line[38:46], line[46:54]))
+                n += 1
+        if n:
+            counts.append(n)
+    if not counts:
+        return np.zeros(0), np.zeros(0)
+
+    coords = np.array(fields, dtype=np.float64)
+    counts = np.array(counts)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    centroids = np.add.reduceat(coords, starts, axis=0) / counts[:, None]
+    d2 = ((coords - np.repeat(centroids, counts, axis=0)) ** 2).sum(axis=1)
+    rg = np.sqrt(np.add.reduceat(d2, starts) / counts)
+    extent = 2 * np.sqrt(np.maximum.reduceat(d2, starts))
+    return rg, extent
+
+def ligand_set_blobs(ligand_dir, library_path=None):
+    # PDBQT bytes of a project's ligand set: the indexed library if there
+    # is one, otherwise every .pdbqt in ligand_dir
+    if library_path and os.path.exists(library_path):
+        for _, _, data in LigandLibrary(library_path).iter_range():
+            yield data
+        return
+    if not os.path.isdir(ligand_dir):
+        return
+    with os.scandir(ligand_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.pdbqt') and entry.is_file():
+                with open(entry.path, 'rb') as f:
+                    yield f.read()
+
+# --- BOX FROM EXTENTS ---
+
+def fit_box_edge(rg, extent, method='gyration', padding=2.0):
+    # Cube edge for the whole set: RG_BOX_FACTOR x the largest radius of
+    # gyration ('gyration') or the largest extent plus padding on each side
+    # ('extent'). Never smaller than the largest extent, so every ligand fits,
+    # nor than MIN_BOX_EDGE.
+    largest = float(extent.max())
+    if method == 'extent':
+        edge = largest + 2 * float(padding)
+    else:
+        edge = max(RG_BOX_FACTOR * float(rg.max()), largest)
+    return round(max(edge, MIN_BOX_EDGE), 3)
+
+def box_estimate(size, reference=None, spacing=GRID_SPACING):
+    # Volume and map grid points of a box (size_x, size_y, size_z). Search
+    # cost grows with the volume, so the relative cost is the volume ratio
+    # to a reference box.
+    volume = float(np.prod(size))
+    estimate = {
+        'size': [round(float(s), 3) for s in size],
+        'volume': round(volume, 1),
+        'grid_points': int(np.prod([math.ceil(float(s) / spacing) + 1 for s in size]))
+    }
+    if reference is not None:
+        estimate['relative_cost'] = round(volume / float(np.prod(reference)), 3)
+    return estimate
+
+class ExtentCache:
+    # Extents per ligand set, recomputed when the library file or the
+    # ligand folder changes (mtime and size)
+
+    def __init__(self):
+        self.entries = {}
+
+    def signature(self, ligand_dir, library_path):
+        path = library_path if library_path and os.path.exists(library_path) else ligand_dir
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (path, stat.st_mtime_ns, stat.st_size)
+
+    def get(self, ligand_dir, library_path=None):
+        signature = self.signature(ligand_dir, library_path)
+        if signature is None:
+            return np.zeros(0), np.zeros(0)
+        entry = self.entries.get(signature[0])
+        if entry is None or entry[0] != signature:
+            entry = self.entries[signature[0]] = (signature, ligand_extents(ligand_set_blobs(ligand_dir, library_path)))
+        return entry[1]
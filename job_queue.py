@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import traceback
+
+# Job states, shared with the /run-status and /job-status responses
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+ERROR = 'error'
+
+class JobQueue:
+    # Persistent local job queue: jobs live in a SQLite file so they survive
+    # a server restart, and at most max_workers of them run at once. limits
+    # caps the running jobs of a kind ({kind: n}); queued jobs of a kind at
+    # its limit wait while later jobs of other kinds go ahead.
+
+    def __init__(self, db_path, max_workers=2, limits=None):
+        self.db_path = db_path
+        self.max_workers = max_workers
+        self.limits = limits or {}
+        self.handlers = {}
+        self.wakeup = threading.Condition()
+        self.workers = []
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    project TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    result TEXT,
+                    message TEXT,
+                    exit_code INTEGER,
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_project ON jobs (project, kind, created)")
+            # Jobs that were running when the server stopped are run again,
+            # flagged so handlers can pick up where they left off
+            conn.execute(
+                "UPDATE jobs SET status = ?, started = NULL, payload = json_set(payload, '$.restarted', 1) WHERE status = ?",
+                (QUEUED, RUNNING)
+            )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def register(self, kind, handler):
+        # handler(payload) -> (exit_code, message, result)
+        self.handlers[kind] = handler
+
+    def start(self):
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    # --- SUBMIT & QUERY ---
+
+    def submit(self, project, kind, payload, exclusive=False):
+        # exclusive: refuse (return None) while the project already has a
+        # queued or running job of this kind. The check and the insert share
+        # one BEGIN IMMEDIATE transaction, so two requests can't both pass it.
+        job_id = uuid.uuid4().hex[:12]
+        conn = self._connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            if exclusive and conn.execute(
+                "SELECT 1 FROM jobs WHERE project = ? AND kind = ? AND status IN (?, ?) LIMIT 1",
+                (project, kind, QUEUED, RUNNING)
+            ).fetchone():
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "INSERT INTO jobs (id, project, kind, status, payload, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, project, kind, QUEUED, json.dumps(payload), time.time())
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        with self.wakeup:
+            self.wakeup.notify()
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row)
+
+    def latest(self, project, kind):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE project = ? AND kind = ? ORDER BY created DESC LIMIT 1",
+                (project, kind)
+            ).fetchone()
+        return self._to_dict(row)
+
+    def active(self, project, kind):
+        job = self.latest(project, kind)
+        if job and job['status'] in (QUEUED, RUNNING):
+            return job
+        return None
+
+    def _to_dict(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        if job['started']:
+            job['elapsed'] = (job['finished'] or time.time()) - job['started']
+        return job
+
+    # --- WORKERS ---
+
+    def _claim(self):
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock, so two workers never
+            # pick up the same job
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            running = dict(conn.execute(
+                "SELECT kind, COUNT(*) FROM jobs WHERE status = ? GROUP BY kind", (RUNNING,)
+            ).fetchall())
+            full = [kind for kind, limit in self.limits.items() if running.get(kind, 0) >= limit]
+            row = conn.execute(
+                f"SELECT * FROM jobs WHERE status = ? AND kind NOT IN ({', '.join('?' * len(full))}) "
+                "ORDER BY created LIMIT 1", (QUEUED, *full)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, started = ? WHERE id = ?",
+                (RUNNING, time.time(), row['id'])
+            )
+            conn.execute("COMMIT")
+            return self._to_dict(row)
+        finally:
+            conn.close()
+
+    def _finish(self, job_id, exit_code, message, result):
+        status = COMPLETED if exit_code == 0 else ERROR
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, exit_code = ?, message = ?, result = ?, finished = ? WHERE id = ?",
+                (status, exit_code, message, json.dumps(result), time.time(), job_id)
+            )
+
+    def _worker(self):
+        # Database errors are logged and the loop carries on, so a locked or
+        # briefly missing queue file never takes a worker down for good
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                print(f"Job queue: could not claim a job: {e}")
+                job = None
+            if job is None:
+                with self.wakeup:
+                    self.wakeup.wait(timeout=1.0)
+                continue
+
+            handler = self.handlers.get(job['kind'])
+            try:
+                if handler is None:
+                    raise ValueError(f"No handler registered for job kind '{job['kind']}'")
+                exit_code, message, result = handler(job['payload'])
+            except Exception as e:
+                traceback.print_exc()
+                exit_code, message, result = 1, str(e), None
+            try:
+                self._finish(job['id'], exit_code, message, result)
+            except Exception as e:
+                # Never leave the job 'running': that would block its project
+                print(f"Job queue: could not record the result of job {job['id']}: {e}")
+                try:
+                    self._finish(job['id'], 1, f"Could not record the job result: {e}", None)
+                except Exception as e:
+                    print(f"Job queue: could not mark job {job['id']} as failed: {e}")
@@ -0,0 +1,144 @@
+import os
+import json
+import hashlib
+import subprocess
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# AutoDock atom type -> element, for the types that are not the element itself
+AD_ELEMENTS = {'A': 'C', 'NA': 'N', 'NS': 'N', 'OA': 'O', 'OS': 'O', 'SA': 'S', 'HD': 'H', 'HS': 'H',
+               'CL': 'Cl', 'BR': 'Br', 'G0': 'C', 'G1': 'C', 'G2': 'C', 'G3': 'C', 'CG0': 'C', 'CG1': 'C'}
+MASSES = {'H': 1.008, 'C': 12.011, 'N': 14.007, 'O': 15.999, 'F': 18.998, 'P': 30.974, 'S': 32.06,
+          'Cl': 35.45, 'Br': 79.904, 'I': 126.904, 'B': 10.81, 'Si': 28.085, 'Se': 78.971,
+          'Fe': 55.845, 'Zn': 65.38, 'Mg': 24.305, 'Ca': 40.078, 'Mn': 54.938}
+
+# --- DESCRIPTORS ---
+
+def pdbqt_descriptors(data):
+    # Molecular weight, rotatable bonds (TORSDOF) and the longest heavy-atom
+    # distance of the prepared conformer, read straight from the PDBQT.
+    mw = 0.0
+    torsions = None
+    heavy = []
+    for line in data.decode('utf-8', errors='replace').splitlines():
+        if line.startswith(('ATOM', 'HETATM')):
+            ad_type = line[77:79].strip().upper()
+            element = AD_ELEMENTS.get(ad_type, ad_type.capitalize())
+            mw += MASSES.get(element, 12.011)
+            if element != 'H':
+                try:
+                    heavy.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+                except ValueError:
+                    pass
+        elif line.startswith('TORSDOF'):
+            try:
+                torsions = int(line.split()[1])
+            except (IndexError, ValueError):
+                pass
+
+    span = 0.0
+    if len(heavy) > 1:
+        coords = np.array(heavy, dtype=np.float32)
+        span = float(np.sqrt(((coords[:, None, :] - coords[None, :, :]) ** 2).sum(axis=2).max()))
+    return {'mw': round(mw, 2), 'rotatable': torsions, 'span': round(span, 2)}
+
+def canonical_key(data):
+    # Canonical SMILES of the largest fragment (salts and counter-ions
+    # removed by -r), hashed; None when Open Babel cannot read the ligand.
+    result = subprocess.run(['obabel', '-ipdbqt', '-ocan', '-r'], input=data, capture_output=True)
+    smiles = result.stdout.decode(errors='replace').split()
+    if result.returncode != 0 or not smiles:
+        return None
+    return hashlib.sha256(smiles[0].encode()).hexdigest()[:32]
+
+def describe(data, with_key=True):
+    # The canonical key costs an obabel process, so it is only computed when
+    # duplicates are being looked for
+    entry = pdbqt_descriptors(data)
+    if with_key:
+        entry['key'] = canonical_key(data)
+    return entry
+
+# --- FILTER ---
+
+class LigandFilter:
+    # Pre-docking filter: drops duplicates (same canonical SMILES, first one
+    # kept), ligands over the molecular weight or rotatable-bond limits, and
+    # ligands whose longest dimension exceeds the box diagonal. Descriptors
+    # are cached by ligand content hash in a JSON-lines file.
+
+    def __init__(self, config, cache_path):
+        self.dedup = bool(config.get('dedup'))
+        self.max_mw = float(config['max_mw']) if config.get('max_mw') else None
+        self.max_rotatable = int(config['max_rotatable']) if config.get('max_rotatable') not in (None, '') else None
+        self.max_span = None
+        if config.get('check_box_fit'):
+            self.max_span = float(np.linalg.norm([float(config[k]) for k in ('size_x', 'size_y', 'size_z')]))
+        self.cache_path = cache_path
+        self.cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.cache[entry['hash']] = entry
+
+    @staticmethod
+    def enabled(config):
+        return bool(config.get('dedup') or config.get('max_mw') or config.get('check_box_fit')
+                    or config.get('max_rotatable') not in (None, ''))
+
+    def reason(self, entry, seen):
+        # Why a ligand is rejected, or None if it passes. Limits are checked
+        # first so a duplicate always points at a ligand that is docked.
+        if self.max_mw is not None and entry['mw'] > self.max_mw:
+            return f"molecular weight {entry['mw']:.1f} > {self.max_mw:g}"
+        if self.max_rotatable is not None and entry['rotatable'] is not None and entry['rotatable'] > self.max_rotatable:
+            return f"{entry['rotatable']} rotatable bonds > {self.max_rotatable}"
+        if self.max_span is not None and entry['span'] > self.max_span:
+            return f"extent {entry['span']:.1f} A does not fit the box (diagonal {self.max_span:.1f} A)"
+        if self.dedup and entry.get('key') is not None:
+            first = seen.setdefault(entry['key'], entry['ligand'])
+            if first != entry['ligand']:
+                return f"duplicate of {first}"
+        return None
+
+    def run(self, items, max_workers=None, chunk_size=256):
+        # items: (name, path, data) as yielded by the runner's LigandSource.
+        # Returns {name: reason} for every rejected ligand.
+        rejected = {}
+        seen = {}
+        with open(self.cache_path, 'a') as cache_file, ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while True:
+                chunk = list(islice(items, chunk_size))
+                if not chunk:
+                    break
+                blobs = []
+                for name, path, data in chunk:
+                    if data is None:
+                        with open(path, 'rb') as f:
+                            data = f.read()
+                    blobs.append((name, data, hashlib.sha256(data).hexdigest()))
+
+                # New ligands, plus cached ones without a key (described while
+                # dedup was off, or obabel failed) once dedup is on
+                missing = {}
+                for name, data, digest in blobs:
+                    cached = self.cache.get(digest)
+                    if cached is None or (self.dedup and cached.get('key') is None):
+                        missing[digest] = data
+                described = pool.map(lambda data: describe(data, self.dedup), missing.values())
+                for digest, entry in zip(missing, described):
+                    self.cache[digest] = entry = {'hash': digest, **entry}
+                    cache_file.write(json.dumps(entry) + "\n")
+
+                # Decided in input order, so the first copy of a duplicate is kept
+                for name, _, digest in blobs:
+                    reason = self.reason({**self.cache[digest], 'ligand': name}, seen)
+                    if reason:
+                        rejected[name] = reason
+        return rejected
@@ -0,0 +1,292 @@
+import os
+import io
+import hashlib
+import shutil
+import zipfile
+import subprocess
+import tempfile
+from array import array
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+# Same conversion as the manual protocol in docs (Ligand Prep)
+OBABEL_OPTIONS = [
+    '--gen3d',
+    '--minimize',
+    '--ff', 'mmff94',
+    '-xh',
+    '--partialcharge', 'gasteiger'
+]
+
+VALID_EXTS = ('.mol2', '.sdf', '.mol', '.cif', '.pdb', '.smi', '.pdbqt')
+
+# --- 1. STREAM MOLECULE RECORDS ---
+
+def stream_records(lines, fmt, base_name):
+    # Yields (name, fmt, text) one molecule at a time from an iterable of
+    # lines. SDF, MOL2 and SMILES hold many molecules; the other formats are
+    # one molecule per file. Names follow the single-file convention: the
+    # base name alone for one record, <base>_<n> when there are several.
+    def records():
+        if fmt == 'sdf':
+            record = []
+            for line in lines:
+                record.append(line)
+                if line.startswith('$$$$'):
+                    yield ''.join(record)
+                    record = []
+            if ''.join(record).strip():
+                yield ''.join(record).rstrip('\n') + '\n$$$$\n'
+        elif fmt == 'mol2':
+            record = []
+            for line in lines:
+                if line.startswith('@<TRIPOS>MOLECULE') and record:
+                    yield ''.join(record)
+                    record = []
+                if record or line.startswith('@<TRIPOS>MOLECULE'):
+                    record.append(line)
+            if record:
+                yield ''.join(record)
+        elif fmt == 'smi':
+            for line in lines:
+                if line.strip() and not line.startswith('#'):
+                    yield line if line.endswith('\n') else line + '\n'
+        else:
+            yield ''.join(lines)
+
+    # One record of lookahead tells a single-molecule file from a library
+    stream = records()
+    first = next(stream, None)
+    if first is None:
+        return
+    second = next(stream, None)
+    if second is None:
+        yield base_name, fmt, first
+        return
+    yield f"{base_name}_1", fmt, first
+    yield f"{base_name}_2", fmt, second
+    for i, record in enumerate(stream, start=3):
+        yield f"{base_name}_{i}", fmt, record
+
+def iter_records(path):
+    # Lazily reads molecules from a structure file or from every structure
+    # file inside a zip archive, without extracting anything to disk.
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as z:
+            for member in z.namelist():
+                if not member.lower().endswith(VALID_EXTS) or member.endswith('/'):
+                    continue
+                base_name = os.path.splitext(os.path.basename(member))[0]
+                fmt = os.path.splitext(member)[1].lower().lstrip('.')
+                with z.open(member) as raw:
+                    lines = io.TextIOWrapper(raw, errors='replace')
+                    yield from stream_records(lines, fmt, base_name)
+        return
+
+    base_name = os.path.splitext(os.path.basename(path))[0]
+    fmt = os.path.splitext(path)[1].lower().lstrip('.')
+    with open(path, 'r', errors='replace') as f:
+        yield from stream_records(f, fmt, base_name)
+
+# --- 2. CONTENT-HASH CACHE ---
+
+def record_hash(fmt, text, options=OBABEL_OPTIONS):
+    h = hashlib.sha256()
+    h.update(fmt.encode())
+    h.update(b'\0')
+    h.update(' '.join(options).encode())
+    h.update(b'\0')
+    h.update(text.encode())
+    return h.hexdigest()
+
+def cache_path_for(cache_dir, digest):
+    # Two-level fan-out keeps any one cache directory small
+    return os.path.join(cache_dir, digest[:2], digest + '.pdbqt')
+
+def convert_record(job):
+    # Runs in a pool worker: converts one molecule into the cache unless the
+    # same input bytes and options were converted before. Already prepared
+    # .pdbqt ligands are stored as they are.
+    name, fmt, text, cache_path = job
+    if os.path.exists(cache_path):
+        return name, cache_path, True, None
+
+    if fmt == 'pdbqt':
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_cache = cache_path + f".{os.getpid()}.tmp"
+        with open(tmp_cache, 'w') as f:
+            f.write(text)
+        os.replace(tmp_cache, cache_path)
+        return name, cache_path, False, None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, f"input.{fmt}")
+        output_path = os.path.join(tmp, "output.pdbqt")
+        with open(input_path, 'w') as f:
+            f.write(text)
+
+        cmd = ['obabel', input_path, '-O', output_path, *OBABEL_OPTIONS]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0 or not os.path.exists(output_path):
+            return name, None, False, result.stderr.strip()
+
+        # Move into place atomically so a half-written file is never reused
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_cache = cache_path + f".{os.getpid()}.tmp"
+        shutil.move(output_path, tmp_cache)
+        os.replace(tmp_cache, cache_path)
+
+    return name, cache_path, False, None
+
+def convert_stream(inputs, cache_dir, max_workers=None, chunk_size=1000):
+    # Converts every record from the input files in bounded chunks, so only
+    # chunk_size records are held in memory at once. Yields
+    # (name, cache_path or None, cache_hit, error) in input order.
+    records = (record for path in inputs for record in iter_records(path))
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                return
+            jobs = [(name, fmt, text, cache_path_for(cache_dir, record_hash(fmt, text)))
+                    for name, fmt, text in chunk]
+            yield from pool.map(convert_record, jobs, chunksize=8)
+
+# --- 3. PARALLEL PREPARATION ---
+
+def prepare_ligands(raw_files, pdbqt_dir, cache_dir, max_workers=None):
+    # One .pdbqt per molecule in pdbqt_dir
+    os.makedirs(pdbqt_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    converted = []
+    cached = 0
+    errors = []
+    seen = set()
+
+    for name, cache_path, hit, error in convert_stream(raw_files, cache_dir, max_workers):
+        if cache_path is None:
+            errors.append(name)
+            if error:
+                print(f"obabel failed for {name}: {error}")
+            continue
+
+        # Record 1 of a.sdf and a separate a_1.sdf are both named a_1; later
+        # ones get a suffix instead of overwriting, as in LibraryWriter
+        unique, n = name, 1
+        while unique in seen:
+            n += 1
+            unique = f"{name}_{n}"
+        seen.add(unique)
+
+        # The project copy is a hard link to the cache entry where possible
+        output_path = os.path.join(pdbqt_dir, unique + '.pdbqt')
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        try:
+            os.link(cache_path, output_path)
+        except OSError:
+            shutil.copyfile(cache_path, output_path)
+
+        converted.append(output_path)
+        cached += hit
+
+    return converted, cached, errors
+
+def prepare_library(inputs, library_path, cache_dir, max_workers=None, chunk_size=1000):
+    # All molecules appended to one indexed library file instead of one
+    # file each; zips are read in place. Returns (count, cached, errors).
+    os.makedirs(cache_dir, exist_ok=True)
+
+    cached = 0
+    errors = []
+    with LibraryWriter(library_path) as writer:
+        for name, cache_path, hit, error in convert_stream(inputs, cache_dir, max_workers, chunk_size):
+            if cache_path is None:
+                errors.append(name)
+                if error:
+                    print(f"obabel failed for {name}: {error}")
+                continue
+            with open(cache_path, 'rb') as f:
+                writer.append(name, f.read())
+            cached += hit
+        count = len(writer)
+
+    return count, cached, errors
+
+# --- 4. INDEXED LIGAND LIBRARY ---
+# <library>.pdbqt   concatenated PDBQT records
+# <library>.idx     uint64 byte offsets, one per record plus the end offset
+# <library>.names   one record name per line
+
+def library_paths(library_path):
+    base = os.path.splitext(library_path)[0]
+    return base + '.idx', base + '.names'
+
+class LibraryWriter:
+    def __init__(self, library_path):
+        self.library_path = library_path
+        self.data = open(library_path + '.tmp', 'wb')
+        self.offsets = array('Q', [0])
+        self.names = []
+        self.seen = set()
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, name, data):
+        # Names must be unique: they become output and CSV names
+        unique, n = name, 1
+        while unique in self.seen:
+            n += 1
+            unique = f"{name}_{n}"
+        self.seen.add(unique)
+        self.names.append(unique)
+
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        self.data.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.data.close()
+        if exc_type is not None:
+            os.remove(self.library_path + '.tmp')
+            return False
+        idx_path, names_path = library_paths(self.library_path)
+        with open(idx_path, 'wb') as f:
+            self.offsets.tofile(f)
+        with open(names_path, 'w') as f:
+            f.write(''.join(name + '\n' for name in self.names))
+        os.replace(self.library_path + '.tmp', self.library_path)
+        return False
+
+class LigandLibrary:
+    # Random access to records of a library written by LibraryWriter
+
+    def __init__(self, library_path):
+        self.library_path = library_path
+        idx_path, names_path = library_paths(library_path)
+        self.offsets = array('Q')
+        with open(idx_path, 'rb') as f:
+            self.offsets.frombytes(f.read())
+        with open(names_path) as f:
+            self.names = f.read().splitlines()
+
+    def __len__(self):
+        return len(self.names)
+
+    def iter_range(self, start=0, end=None):
+        # Yields (index, name, bytes) for records start..end-1
+        end = len(self) if end is None else min(end, len(self))
+        return self.iter_indices(range(start, end))
+
+    def iter_indices(self, indices):
+        # Yields (index, name, bytes) for the given record indices
+        with open(self.library_path, 'rb') as f:
+            for i in indices:
+                f.seek(self.offsets[i])
+                yield i, self.names[i], f.read(self.offsets[i + 1] - self.offsets[i])
@@ -0,0 +1,135 @@
+import math
+
+import numpy as np
+
+try:
+    from scipy import ndimage
+except ImportError:  # Connected components fall back to label propagation
+    ndimage = None
+
+from box_sizing import MIN_BOX_EDGE
+
+# LIGSITE scan lines: the three axes and the four cube diagonals. A voxel
+# is buried along a line when protein lies within reach on both sides.
+DIRECTIONS = ((1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 1), (1, 1, -1), (1, -1, 1), (-1, 1, 1))
+FACE_NEIGHBOURS = ((1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1))
+
+# --- GRID ---
+
+def occupancy_grid(coords, spacing=1.0, atom_radius=1.8, margin=4.0):
+    # Boolean voxel grid over the protein's bounding box (plus margin); a
+    # voxel is occupied when its center is within atom_radius of an atom.
+    # Returns (occupied, origin), origin being the position of voxel 0,0,0.
+    origin = coords.min(axis=0) - margin
+    shape = tuple(int(n) for n in np.ceil((coords.max(axis=0) + margin - origin) / spacing) + 1)
+    occupied = np.zeros(shape, dtype=bool)
+
+    # Every atom marks the same sphere of voxel offsets around its own voxel
+    reach = int(math.ceil(atom_radius / spacing))
+    steps = np.arange(-reach, reach + 1)
+    offsets = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets = offsets[(offsets ** 2).sum(axis=1) * spacing ** 2 <= atom_radius ** 2]
+
+    cells = np.rint((coords - origin) / spacing).astype(np.int64)
+    upper = np.array(shape) - 1
+    for start in range(0, len(cells), 8192):
+        marked = np.clip((cells[start:start + 8192, None, :] + offsets[None, :, :]).reshape(-1, 3), 0, upper)
+        occupied[marked[:, 0], marked[:, 1], marked[:, 2]] = True
+    return occupied, origin
+
+def shifted(grid, offset, fill=0):
+    # out[i] = grid[i + offset], fill outside the grid
+    out = np.full_like(grid, fill)
+    if any(abs(o) >= n for o, n in zip(offset, grid.shape)):
+        return out
+    src = tuple(slice(max(o, 0), n + min(o, 0)) for o, n in zip(offset, grid.shape))
+    dst = tuple(slice(max(-o, 0), n + min(-o, 0)) for o, n in zip(offset, grid.shape))
+    out[dst] = grid[src]
+    return out
+
+def buriedness(occupied, spacing=1.0, max_distance=8.0):
+    # Number of scan lines (0-7) along which each voxel has protein within
+    # max_distance on both sides; whole-grid shifts, no per-voxel loop
+    count = np.zeros(occupied.shape, dtype=np.int8)
+    for direction in DIRECTIONS:
+        direction = np.array(direction)
+        reach = max(1, int(max_distance / (spacing * np.linalg.norm(direction))))
+        ahead = np.zeros_like(occupied)
+        behind = np.zeros_like(occupied)
+        for k in range(1, reach + 1):
+            ahead |= shifted(occupied, k * direction)
+            behind |= shifted(occupied, -k * direction)
+        count += ahead & behind
+    return count
+
+def label_components(mask):
+    # Face-connected components of a boolean grid: (labels, count), labels
+    # 1..count and 0 outside the mask
+    if ndimage is not None:
+        return ndimage.label(mask)
+
+    # Without scipy: every voxel takes the smallest id among its neighbours
+    # until nothing changes, then ids are renumbered 1..count
+    empty = mask.size + 1
+    labels = np.where(mask, np.arange(mask.size).reshape(mask.shape), empty)
+    while True:
+        merged = labels
+        for offset in FACE_NEIGHBOURS:
+            merged = np.minimum(merged, shifted(labels, offset, fill=empty))
+        merged[~mask] = empty
+        if np.array_equal(merged, labels):
+            break
+        labels = merged
+    ids, labels = np.unique(labels, return_inverse=True)
+    labels = (labels.reshape(mask.shape) + 1) * mask
+    return labels, int((ids != empty).sum())
+
+# --- POCKETS ---
+
+def detect_pockets(coords, spacing=1.0, min_buriedness=5, min_volume=50.0, padding=4.0, max_pockets=10):
+    # Grid-based cavity search (LIGSITE-style): empty voxels buried along at
+    # least min_buriedness of the seven scan lines are grouped into
+    # connected pockets, ranked by total buriedness. Each pocket gets a
+    # docking box around its voxels, padding on every side.
+    if len(coords) == 0:
+        return []
+    occupied, origin = occupancy_grid(coords, spacing)
+    buried = buriedness(occupied, spacing)
+    labels, count = label_components(~occupied & (buried >= min_buriedness))
+    if count == 0:
+        return []
+
+    flat = labels.ravel()
+    inside = np.flatnonzero(flat)
+    ids = flat[inside] - 1
+    order = np.argsort(ids, kind='stable')
+    ids = ids[order]
+    points = origin + np.column_stack(np.unravel_index(inside[order], labels.shape)) * spacing
+    starts = np.searchsorted(ids, np.arange(count))
+
+    voxels = np.bincount(ids, minlength=count)
+    score = np.bincount(ids, weights=buried.ravel()[inside[order]], minlength=count)
+    lo = np.minimum.reduceat(points, starts, axis=0)
+    hi = np.maximum.reduceat(points, starts, axis=0)
+
+    pockets = []
+    for i in np.argsort(-score):
+        volume = float(voxels[i] * spacing ** 3)
+        if volume < min_volume:
+            continue
+        center = (lo[i] + hi[i]) / 2
+        size = np.maximum(hi[i] - lo[i] + 2 * padding, MIN_BOX_EDGE)
+        pockets.append({
+            'rank': len(pockets) + 1,
+            'center_x': round(float(center[0]), 3),
+            'center_y': round(float(center[1]), 3),
+            'center_z': round(float(center[2]), 3),
+            'size_x': round(float(size[0]), 3),
+            'size_y': round(float(size[1]), 3),
+            'size_z': round(float(size[2]), 3),
+            'volume': round(volume, 1),
+            'buriedness': round(float(score[i] / voxels[i]), 2)
+        })
+        if len(pockets) == max_pockets:
+            break
+    return pockets
@@ -0,0 +1,187 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # Distance queries fall back to chunked brute force
+    cKDTree = None
+
+class ReceptorArrays:
+    # Column-oriented view of a PDB: one NumPy array per field, one row per
+    # atom. Selections are boolean masks over the rows.
+
+    FIELDS = ('coords', 'chain', 'resid', 'resname', 'element', 'name', 'hetero')
+
+    def __init__(self, coords, chain, resid, resname, element, name, hetero):
+        self.coords = coords
+        self.chain = chain
+        self.resid = resid
+        self.resname = resname
+        self.element = element
+        self.name = name
+        self.hetero = hetero
+        self._tree = None
+
+    def __len__(self):
+        return len(self.coords)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, field).nbytes for field in self.FIELDS)
+
+    def save_npz(self, path, content_hash):
+        # Written to a temp name first so readers never see a partial file
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, content_hash=np.array(content_hash),
+                 **{field: getattr(self, field) for field in self.FIELDS})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load_npz(cls, path, content_hash):
+        # Returns None when the file is missing or belongs to other content
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data['content_hash']) != content_hash:
+                    return None
+                return cls(*(data[field] for field in cls.FIELDS))
+        except (OSError, KeyError, ValueError):
+            return None
+
+    @classmethod
+    def from_pdb(cls, path):
+        # Fixed-column parse of ATOM/HETATM records (all models, like
+        # Bio.PDB's structure.get_atoms())
+        coords, chain, resid, resname, element, name, hetero = [], [], [], [], [], [], []
+        with open(path, 'r', errors='replace') as f:
+            for line in f:
+                record = line[:6]
+                if record != 'ATOM  ' and record != 'HETATM':
+                    continue
+                try:
+                    coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+                    resid.append(int(line[22:26]))
+                except ValueError:
+                    continue
+                atom_name = line[12:16].strip()
+                chain.append(line[21])
+                resname.append(line[17:20].strip())
+                name.append(atom_name)
+                element.append(line[76:78].strip() or atom_name.lstrip('0123456789')[:1])
+                hetero.append(record == 'HETATM')
+
+        return cls(
+            np.array(coords, dtype=np.float32).reshape(-1, 3),
+            np.array(chain, dtype='U1'),
+            np.array(resid, dtype=np.int32),
+            np.array(resname, dtype='U3'),
+            np.array(element, dtype='U2'),
+            np.array(name, dtype='U4'),
+            np.array(hetero, dtype=bool)
+        )
+
+    # --- SELECTIONS ---
+
+    def residue_mask(self, residues):
+        # residues: ["A:145", "B:41", ...]
+        mask = np.zeros(len(self), dtype=bool)
+        for residue in residues:
+            chain_id, res_id = residue.strip().split(':')
+            mask |= (self.chain == chain_id.strip()) & (self.resid == int(res_id.strip()))
+        return mask
+
+    def resname_mask(self, resname, hetero_only=True):
+        mask = self.resname == resname.strip().upper()
+        if hetero_only:
+            mask &= self.hetero
+        return mask
+
+    def within(self, mask, radius):
+        # All atoms within radius (A) of any selected atom, selection included
+        if not mask.any():
+            return mask
+        query = self.coords[mask]
+
+        if cKDTree is not None:
+            if self._tree is None:
+                self._tree = cKDTree(self.coords)
+            hits = self._tree.query_ball_point(query, r=radius, return_sorted=False)
+            result = mask.copy()
+            hits = [idx for idx in hits if idx]
+            if hits:
+                result[np.concatenate(hits)] = True
+            return result
+
+        # Without scipy: only atoms inside the padded bounding box of the
+        # selection are candidates, compared in chunks to bound memory
+        lo = query.min(axis=0) - radius
+        hi = query.max(axis=0) + radius
+        candidates = np.flatnonzero(np.all((self.coords >= lo) & (self.coords <= hi), axis=1))
+        result = mask.copy()
+        r2 = radius * radius
+        for start in range(0, len(candidates), 4096):
+            chunk = candidates[start:start + 4096]
+            d2 = ((self.coords[chunk, None, :] - query[None, :, :]) ** 2).sum(axis=2)
+            result[chunk[(d2 <= r2).any(axis=1)]] = True
+        return result
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class ReceptorCache:
+    # LRU of parsed receptors keyed by file content hash, bounded by the
+    # arrays' total size. Each parse is also saved as <receptor>.npz so a
+    # restarted server loads it without re-parsing the PDB.
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # path -> ((mtime, size), content hash), so unchanged files are not
+        # rehashed; a rehash replaces the path's old version
+        self.hashes = {}
+
+    def content_hash(self, path):
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self.hashes.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        digest = file_sha256(path)
+        self.hashes[path] = (version, digest)
+        return digest
+
+    def get(self, path):
+        digest = self.content_hash(path)
+        with self.lock:
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+                return self.entries[digest]
+
+        npz_path = os.path.splitext(path)[0] + '.npz'
+        receptor = ReceptorArrays.load_npz(npz_path, digest)
+        if receptor is None:
+            receptor = ReceptorArrays.from_pdb(path)
+            try:
+                receptor.save_npz(npz_path, digest)
+            except OSError as e:
+                print(f"Could not write receptor cache {npz_path}: {e}")
+
+        with self.lock:
+            if digest not in self.entries:
+                self.entries[digest] = receptor
+                self.total_bytes += receptor.nbytes
+                # Evict least recently used, but always keep the newest entry
+                while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.total_bytes -= evicted.nbytes
+            return self.entries[digest]
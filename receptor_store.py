@@ -0,0 +1,133 @@
+import os
+import sys
+import glob
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+# Options passed to prepare_receptor4.py; part of the store key
+PREP_OPTIONS = ['-A', 'checkhydrogens']
+
+DEFAULT_STORE = './workspace/cache/receptors'
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+def prep_key(input_pdb, options=PREP_OPTIONS):
+    h = hashlib.sha256()
+    h.update(' '.join(options).encode())
+    h.update(b'\0')
+    with open(input_pdb, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+class ReceptorStore:
+    # Content-addressed store of prepared receptors: <store>/<key>.pdbqt,
+    # keyed by the input PDB bytes plus the MGLTools options. Entries are
+    # evicted oldest-used first once the store grows past max_bytes.
+
+    def __init__(self, store_dir=DEFAULT_STORE, max_bytes=DEFAULT_MAX_BYTES):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        os.makedirs(store_dir, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.store_dir, key + '.pdbqt')
+
+    def prepare(self, input_pdb, output_pdbqt, mgl_python, prepare_script, options=PREP_OPTIONS):
+        # Returns (cached, stderr). output_pdbqt exists afterwards on success.
+        key = prep_key(input_pdb, options)
+        stored = self.path_for(key)
+
+        if os.path.exists(stored):
+            os.utime(stored)  # mark as recently used
+            link_or_copy(stored, output_pdbqt)
+            return True, ""
+
+        tmp_path = stored + f".{os.getpid()}.tmp.pdbqt"
+        cmd = [mgl_python, prepare_script, '-r', os.path.abspath(input_pdb), '-o', tmp_path, *options]
+
+        print(f"--- EXECUTING MGLTOOLS ---\nCommand: {' '.join(cmd)}")
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        print("STDOUT:", result.stdout)
+        print("STDERR:", result.stderr)
+
+        if not os.path.exists(tmp_path):
+            return False, result.stderr
+
+        os.replace(tmp_path, stored)
+        link_or_copy(stored, output_pdbqt)
+        self.evict()
+        return False, result.stderr
+
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.store_dir, '*.pdbqt')):
+            if '.tmp.' in path:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+# --- CLI: pre-warm the store before a screening campaign ---
+# python receptor_store.py prewarm target1.pdb target2.pdb \
+#     --mgl-python /path/to/pythonsh --prepare-script /path/to/prepare_receptor4.py
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepared receptor store")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    prewarm = sub.add_parser('prewarm', help="Prepare receptors into the store ahead of time")
+    prewarm.add_argument('pdb_files', nargs='+')
+    prewarm.add_argument('--store', default=DEFAULT_STORE)
+    prewarm.add_argument('--max-gb', type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3)
+    prewarm.add_argument('--mgl-python', default=os.environ.get('MGL_PYTHON'))
+    prewarm.add_argument('--prepare-script', default=os.environ.get('PREPARE_RECEPTOR'))
+
+    args = parser.parse_args()
+    if not args.mgl_python or not args.prepare_script:
+        parser.error("--mgl-python and --prepare-script (or MGL_PYTHON / PREPARE_RECEPTOR) are required")
+
+    store = ReceptorStore(args.store, int(args.max_gb * 1024 ** 3))
+    failed = 0
+    for pdb in args.pdb_files:
+        key = prep_key(pdb)
+        stored = store.path_for(key)
+        if os.path.exists(stored):
+            print(f"{pdb}: already in store ({key[:12]})")
+            continue
+        # Prepare into the store only; the project copy is made on demand
+        with tempfile.TemporaryDirectory() as tmp:
+            cached, stderr = store.prepare(pdb, os.path.join(tmp, 'receptor.pdbqt'),
+                                           args.mgl_python, args.prepare_script)
+        if os.path.exists(stored):
+            print(f"{pdb}: prepared ({key[:12]})")
+        else:
+            failed += 1
+            print(f"{pdb}: FAILED\n{stderr}", file=sys.stderr)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import os
+import io
+import csv
+import glob
+import time
+import zlib
+import struct
+import hashlib
+import tempfile
+
+CHUNK = 1 << 20
+
+# Files that are never archived: SQLite side files and scratch data
+SKIP_SUFFIXES = ('-wal', '-shm', '.tmp')
+
+ZIP64_LIMIT = 0xFFFFFFFF
+
+def dos_time(mtime):
+    t = time.localtime(max(mtime, 315532800))  # DOS dates start in 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+# --- COMPRESSED MEMBER CACHE ---
+
+class MemberCache:
+    # Raw deflate data per results file, kept between downloads. An entry is
+    # keyed by the file's absolute path, size and mtime, so an unchanged file
+    # is never recompressed; a changed file replaces its old entry.
+    # Entry layout: crc32 (uint32), uncompressed size (uint64), deflate data.
+
+    HEADER = struct.Struct('<IQ')
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def path_key(path):
+        return hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+
+    def entry_path(self, path, stat):
+        path_key = self.path_key(path)
+        version = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{path_key}-{version}.deflate"), path_key
+
+    def get(self, path):
+        # Returns (entry_path, crc, size, compressed_size), compressing first if needed
+        stat = os.stat(path)
+        entry, path_key = self.entry_path(path, stat)
+        if not os.path.exists(entry):
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as out, open(path, 'rb') as f:
+                    out.write(self.HEADER.pack(0, 0))
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                    crc = size = 0
+                    for chunk in iter(lambda: f.read(CHUNK), b''):
+                        crc = zlib.crc32(chunk, crc)
+                        size += len(chunk)
+                        out.write(compressor.compress(chunk))
+                    out.write(compressor.flush())
+                    out.seek(0)
+                    out.write(self.HEADER.pack(crc, size))
+                # Concurrent downloads may build the same entry; last rename wins
+                os.replace(tmp_path, entry)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            for stale in glob.glob(os.path.join(self.cache_dir, path_key + '-*.deflate')):
+                if stale != entry:
+                    try:
+                        os.remove(stale)
+                    except OSError:
+                        pass
+
+        with open(entry, 'rb') as f:
+            crc, size = self.HEADER.unpack(f.read(self.HEADER.size))
+        return entry, crc, size, os.path.getsize(entry) - self.HEADER.size
+
+    def prune(self, paths):
+        # Drops the entries of every file not in paths (the full listing of
+        # the results dir), i.e. files deleted or renamed since they were cached
+        keep = {self.path_key(path) for path in paths}
+        for entry in glob.glob(os.path.join(self.cache_dir, '*.deflate')):
+            if os.path.basename(entry).split('-', 1)[0] not in keep:
+                try:
+                    os.remove(entry)
+                except OSError:
+                    pass
+
+# --- STREAMED ZIP WRITER ---
+# Each member is compressed (or taken from the cache) before its header is
+# written, so sizes are known up front and the archive can be produced as a
+# plain stream of chunks. ZIP64 records are added only when needed.
+
+def zip_stream(members, cache):
+    # members: iterable of (arcname, source, mtime), source being a file path
+    # (cached) or bytes (compressed on the fly). Yields the archive in chunks.
+    central = []
+    offset = 0
+
+    for arcname, source, mtime in members:
+        if isinstance(source, bytes):
+            crc = zlib.crc32(source)
+            size = len(source)
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            data = compressor.compress(source) + compressor.flush()
+            entry, compressed_size = None, len(data)
+        else:
+            try:
+                entry, crc, size, compressed_size = cache.get(source)
+            except FileNotFoundError:
+                continue  # removed since it was listed
+            data = None
+
+        name = arcname.encode('utf-8')
+        mod_time, mod_date = dos_time(mtime)
+        zip64 = size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 1, 16, size, compressed_size) if zip64 else b''
+        header = struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, 0x800, 8, mod_time, mod_date, crc,
+            ZIP64_LIMIT if zip64 else compressed_size, ZIP64_LIMIT if zip64 else size, len(name), len(extra)
+        )
+        yield header + name + extra
+
+        if data is not None:
+            yield data
+        else:
+            with open(entry, 'rb') as f:
+                f.seek(MemberCache.HEADER.size)
+                for chunk in iter(lambda: f.read(CHUNK), b''):
+                    yield chunk
+
+        central.append((name, crc, size, compressed_size, offset, mod_time, mod_date))
+        offset += len(header) + len(name) + len(extra) + compressed_size
+
+    cd_start = offset
+    cd = io.BytesIO()
+    for name, crc, size, compressed_size, member_offset, mod_time, mod_date in central:
+        zip64 = max(size, compressed_size, member_offset) >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQQ', 1, 24, size, compressed_size, member_offset) if zip64 else b''
+        cd.write(struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 45, 45 if zip64 else 20, 0x800, 8, mod_time, mod_date, crc,
+            ZIP64_LIMIT if zip64 else compressed_size, ZIP64_LIMIT if zip64 else size,
+            len(name), len(extra), 0, 0, 0, 0o644 << 16, ZIP64_LIMIT if zip64 else member_offset
+        ))
+        cd.write(name + extra)
+    cd_size = cd.tell()
+
+    end = b''
+    count = len(central)
+    if count >= 0xFFFF or cd_start >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+        eocd64_offset = cd_start + cd_size
+        end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_start)
+        end += struct.pack('<IIQI', 0x07064b50, 0, eocd64_offset, 1)
+    end += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                       min(cd_size, ZIP64_LIMIT), min(cd_start, ZIP64_LIMIT), 0)
+    yield cd.getvalue() + end
+
+# --- WHAT GOES INTO THE ARCHIVE ---
+
+def results_members(results_dir, cache=None):
+    # Every results file, walked lazily; hidden files and dirs are skipped.
+    # Once the walk is complete, cache entries of files not seen are dropped.
+    listed = []
+    for root, dirs, files in os.walk(results_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if name.startswith('.') or name.endswith(SKIP_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, results_dir).replace(os.sep, '/')
+            listed.append(path)
+            yield relpath, path, os.path.getmtime(path)
+    if cache is not None:
+        cache.prune(listed)
+
+def selected_members(results_dir, rows, header, store=None):
+    # The filtered score table plus each selected ligand's poses, taken from
+    # its *_out.pdbqt or rebuilt from the packed results store.
+    now = time.time()
+    table = io.StringIO()
+    writer = csv.writer(table)
+    writer.writerow(header)
+    writer.writerows(rows)
+    yield 'docking_scores.csv', table.getvalue().encode(), now
+
+    for row in rows:
+        base_name = os.path.splitext(row[0])[0]
+        arcname = f"poses/{base_name}_out.pdbqt"
+        out_file = os.path.join(results_dir, f"{base_name}_out.pdbqt")
+        if os.path.exists(out_file):
+            yield arcname, out_file, os.path.getmtime(out_file)
+        elif store is not None:
+            pdbqt = store.export_pdbqt(row[0])
+            if pdbqt is not None:
+                yield arcname, pdbqt.encode(), now
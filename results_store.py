@@ -0,0 +1,256 @@
+import os
+import fcntl
+import zlib
+import sqlite3
+import subprocess
+import tempfile
+
+import numpy as np
+
+# One file per results directory, next to docking_scores.csv
+STORE_NAME = 'results.sqlite'
+
+# Vina's per-model energy breakdown, which would be wrong on other poses
+POSE_REMARKS = ('REMARK INTER', 'REMARK INTRA', 'REMARK UNBOUND')
+
+def parse_pose_file(path):
+    # Reads a vina/unidock *_out.pdbqt. Returns (template, poses): the first
+    # model's lines (coordinates are filled back in on export) and one
+    # (affinity, rmsd_lb, rmsd_ub, coords) per model, coords as float32 (n, 3).
+    # A missing file has no poses.
+    template = []
+    poses = []
+    scores = None
+    coords = []
+    first = True
+
+    def close_model():
+        if coords:
+            poses.append((*(scores or (None, None, None)), np.array(coords, dtype=np.float32)))
+
+    if not os.path.exists(path):
+        return '', poses
+
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            if line.startswith('MODEL'):
+                scores, coords = None, []
+                continue
+            if line.startswith('ENDMDL'):
+                close_model()
+                scores, coords = None, []
+                first = False
+                continue
+            if line.startswith('REMARK VINA RESULT:'):
+                fields = line.split()
+                scores = tuple(float(x) for x in fields[3:6])
+                continue
+            if line.startswith(POSE_REMARKS):
+                continue  # per-pose energy terms; only the scores are kept
+            if line.startswith(('ATOM', 'HETATM')):
+                coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+            if first:
+                template.append(line)
+
+    # Single-pose files have no MODEL/ENDMDL records
+    close_model()
+    return ''.join(template), poses
+
+class ResultsStore:
+    # Packed docking results in SQLite: one row per ligand (best score,
+    # metadata, a zlib-compressed PDBQT template) and one row per pose with
+    # its coordinates as a float32 blob. The affinity index serves top-K
+    # queries; PDBQT/SDF are only rebuilt when a ligand is exported.
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        # WAL lets the web app read while the runner is still writing
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS ligands (
+                id INTEGER PRIMARY KEY,
+                name TEXT UNIQUE NOT NULL,
+                affinity REAL,
+                rmsd_lb REAL,
+                n_poses INTEGER NOT NULL,
+                n_atoms INTEGER NOT NULL,
+                torsions INTEGER,
+                template BLOB NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ligands_affinity ON ligands (affinity)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS poses (
+                ligand_id INTEGER NOT NULL,
+                mode INTEGER NOT NULL,
+                affinity REAL,
+                rmsd_lb REAL,
+                rmsd_ub REAL,
+                coords BLOB NOT NULL,
+                PRIMARY KEY (ligand_id, mode)
+            )
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM ligands").fetchone()[0]
+
+    def has(self, name):
+        return self.conn.execute("SELECT 1 FROM ligands WHERE name = ?", (name,)).fetchone() is not None
+
+    # --- WRITE ---
+
+    def add(self, name, out_file):
+        # Packs every pose of one docked ligand; replaces an earlier entry.
+        # Returns the number of poses stored (0 if the file held none).
+        template, poses = parse_pose_file(out_file)
+        if not poses:
+            return 0
+
+        torsions = None
+        for line in template.splitlines():
+            if line.startswith('TORSDOF'):
+                torsions = int(line.split()[1])
+
+        best = poses[0]
+        with self.conn:
+            self.conn.execute("DELETE FROM poses WHERE ligand_id IN (SELECT id FROM ligands WHERE name = ?)", (name,))
+            self.conn.execute("DELETE FROM ligands WHERE name = ?", (name,))
+            cursor = self.conn.execute(
+                "INSERT INTO ligands (name, affinity, rmsd_lb, n_poses, n_atoms, torsions, template) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name, best[0], best[1], len(poses), len(best[3]), torsions, zlib.compress(template.encode()))
+            )
+            ligand_id = cursor.lastrowid
+            self.conn.executemany(
+                "INSERT INTO poses (ligand_id, mode, affinity, rmsd_lb, rmsd_ub, coords) VALUES (?, ?, ?, ?, ?, ?)",
+                [(ligand_id, mode, affinity, rmsd_lb, rmsd_ub, coords.tobytes())
+                 for mode, (affinity, rmsd_lb, rmsd_ub, coords) in enumerate(poses, start=1)]
+            )
+        return len(poses)
+
+    def merge(self, other_path):
+        # Copies every ligand and its poses from another store (e.g. one
+        # shard's); entries with the same name are replaced. Returns the
+        # number of ligands copied.
+        self.conn.execute("ATTACH DATABASE ? AS other", (other_path,))
+        try:
+            with self.conn:
+                self.conn.execute("""
+                    DELETE FROM poses WHERE ligand_id IN
+                    (SELECT id FROM ligands WHERE name IN (SELECT name FROM other.ligands))
+                """)
+                self.conn.execute("DELETE FROM ligands WHERE name IN (SELECT name FROM other.ligands)")
+                copied = self.conn.execute("""
+                    INSERT INTO ligands (name, affinity, rmsd_lb, n_poses, n_atoms, torsions, template)
+                    SELECT name, affinity, rmsd_lb, n_poses, n_atoms, torsions, template FROM other.ligands
+                """).rowcount
+                # Ligand ids are reassigned; poses follow their ligand by name
+                self.conn.execute("""
+                    INSERT INTO poses (ligand_id, mode, affinity, rmsd_lb, rmsd_ub, coords)
+                    SELECT l.id, p.mode, p.affinity, p.rmsd_lb, p.rmsd_ub, p.coords
+                    FROM other.poses p
+                    JOIN other.ligands o ON o.id = p.ligand_id
+                    JOIN main.ligands l ON l.name = o.name
+                """)
+        finally:
+            self.conn.execute("DETACH DATABASE other")
+        return copied
+
+    # --- QUERY ---
+
+    def top(self, k=10):
+        # Best-scoring ligands first: [(name, affinity, rmsd_lb), ...]
+        return self.conn.execute(
+            "SELECT name, affinity, rmsd_lb FROM ligands WHERE affinity IS NOT NULL ORDER BY affinity LIMIT ?",
+            (k,)
+        ).fetchall()
+
+    def poses(self, name):
+        # [{'mode', 'affinity', 'rmsd_lb', 'rmsd_ub', 'coords'}, ...] for one ligand
+        rows = self.conn.execute("""
+            SELECT p.mode, p.affinity, p.rmsd_lb, p.rmsd_ub, p.coords, l.n_atoms
+            FROM poses p JOIN ligands l ON l.id = p.ligand_id
+            WHERE l.name = ? ORDER BY p.mode
+        """, (name,)).fetchall()
+        return [{
+            'mode': mode, 'affinity': affinity, 'rmsd_lb': rmsd_lb, 'rmsd_ub': rmsd_ub,
+            'coords': np.frombuffer(coords, dtype=np.float32).reshape(n_atoms, 3)
+        } for mode, affinity, rmsd_lb, rmsd_ub, coords, n_atoms in rows]
+
+    # --- EXPORT ---
+
+    def export_pdbqt(self, name, n_poses=None):
+        # Rebuilds the multi-model PDBQT in the layout vina writes; None if unknown
+        row = self.conn.execute("SELECT template FROM ligands WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        template = zlib.decompress(row[0]).decode().splitlines(keepends=True)
+
+        out = []
+        for pose in self.poses(name)[:n_poses]:
+            out.append(f"MODEL {pose['mode']}\n")
+            if pose['affinity'] is not None:
+                out.append(f"REMARK VINA RESULT: {pose['affinity']:>8.3f} {pose['rmsd_lb']:>10.3f} {pose['rmsd_ub']:>10.3f}\n")
+            atom = 0
+            for line in template:
+                if line.startswith(('ATOM', 'HETATM')):
+                    x, y, z = pose['coords'][atom]
+                    line = f"{line[:30]}{x:8.3f}{y:8.3f}{z:8.3f}{line[54:]}"
+                    atom += 1
+                out.append(line)
+            out.append("ENDMDL\n")
+        return ''.join(out)
+
+    def export_sdf(self, name, n_poses=None):
+        # PDBQT -> SDF through Open Babel, as in ligand prep
+        pdbqt = self.export_pdbqt(name, n_poses)
+        if pdbqt is None:
+            return None
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, 'poses.pdbqt')
+            output_path = os.path.join(tmp, 'poses.sdf')
+            with open(input_path, 'w') as f:
+                f.write(pdbqt)
+            result = subprocess.run(['obabel', input_path, '-O', output_path], capture_output=True, text=True)
+            if result.returncode != 0 or not os.path.exists(output_path):
+                raise RuntimeError(f"obabel failed: {result.stderr.strip()}")
+            with open(output_path) as f:
+                return f.read()
+
+def remove_store(path):
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+# --- RUNNER LOCK ---
+# A runner holds an exclusive lock on this file for as long as it runs (the
+# OS drops it however the process ends), so two runners never write the same
+# scores, checkpoint and store. The file holds the PID of the holder.
+RUN_LOCK_NAME = '.runner.lock'
+
+def lock_results_dir(results_dir, wait=False):
+    # The open lock file (keep it open to hold the lock), or None when another
+    # process holds it and wait is False
+    lock_file = open(os.path.join(results_dir, RUN_LOCK_NAME), 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    lock_file.truncate(0)
+    lock_file.write(f"{os.getpid()}\n")
+    lock_file.flush()
+    return lock_file
+
+def lock_holder(results_dir):
+    try:
+        with open(os.path.join(results_dir, RUN_LOCK_NAME)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
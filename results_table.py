@@ -0,0 +1,146 @@
+import os
+import re
+import csv
+import fnmatch
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+SORT_KEYS = ('affinity', '-affinity', 'name', '-name')
+
+class ResultsTable:
+    # docking_scores.csv as NumPy columns, one row per ligand. Sort orders
+    # are computed once per key and reused by every query; failed ligands
+    # (ERROR rows) have a NaN affinity and always sort last. The CSV text is
+    # kept as well, so rows are returned exactly as the runner wrote them.
+
+    def __init__(self, header, names, affinity, rmsd_lb, text):
+        self.header = header
+        self.names = names
+        self.affinity = affinity
+        self.rmsd_lb = rmsd_lb
+        self.text = text
+        self.orders = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_csv(cls, csv_path):
+        names, affinity, rmsd_lb, text = [], [], [], []
+        with open(csv_path, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            for row in reader:
+                if len(row) < 3:
+                    continue
+                names.append(row[0])
+                affinity.append(parse_float(row[1]))
+                rmsd_lb.append(parse_float(row[2]))
+                # Extra columns (two-stage, ensemble) are returned as well
+                text.append(tuple(row[1:]))
+        return cls(header, np.array(names, dtype=object), np.array(affinity, dtype=np.float64),
+                   np.array(rmsd_lb, dtype=np.float64), text)
+
+    def order(self, sort):
+        if sort not in self.orders:
+            if sort.lstrip('-') == 'affinity':
+                # NaNs go last in both directions
+                key = self.affinity if sort == 'affinity' else -self.affinity
+                self.orders[sort] = np.argsort(key, kind='stable')
+            else:
+                ascending = np.argsort(self.names.astype(str), kind='stable')
+                self.orders[sort] = ascending if sort == 'name' else ascending[::-1]
+        return self.orders[sort]
+
+    def mask(self, max_affinity=None, min_affinity=None, pattern=None, failed=True):
+        # Rows passing every given filter; pattern is a case-insensitive glob
+        mask = np.ones(len(self), dtype=bool)
+        docked = ~np.isnan(self.affinity)
+        if not failed or max_affinity is not None or min_affinity is not None:
+            mask &= docked
+        with np.errstate(invalid='ignore'):
+            if max_affinity is not None:
+                mask &= self.affinity <= max_affinity
+            if min_affinity is not None:
+                mask &= self.affinity >= min_affinity
+        if pattern:
+            match = re.compile(fnmatch.translate(pattern), re.IGNORECASE).match
+            mask &= np.fromiter((match(name) is not None for name in self.names), dtype=bool, count=len(self))
+        return mask
+
+    def select(self, sort='affinity', **filters):
+        # Row indices in sort order that pass the filters
+        order = self.order(sort)
+        return order[self.mask(**filters)[order]]
+
+    def rows(self, indices):
+        return [[self.names[i], *self.text[i]] for i in indices]
+
+    def histogram(self, indices, bins=20):
+        values = self.affinity[indices]
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return {'edges': [], 'counts': []}
+        counts, edges = np.histogram(values, bins=bins)
+        return {'edges': np.round(edges, 3).tolist(), 'counts': counts.tolist()}
+
+    def summary(self, indices):
+        values = self.affinity[indices]
+        docked = values[~np.isnan(values)]
+        return {
+            'count': int(len(values)),
+            'docked': int(len(docked)),
+            'failed': int(len(values) - len(docked)),
+            # Dropped by the pre-docking filter (counted in failed too)
+            'rejected': sum(self.text[i][0] == 'REJECTED' for i in indices),
+            'best': float(docked.min()) if len(docked) else None,
+            'worst': float(docked.max()) if len(docked) else None,
+            'mean': round(float(docked.mean()), 3) if len(docked) else None
+        }
+
+def parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+class ResultsTableCache:
+    # One parsed table per results directory, rebuilt when docking_scores.csv
+    # or checkpoint.jsonl changes (size or mtime), so a finished or resumed
+    # run is picked up on the next query without re-reading on every call.
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def signature(self, results_dir):
+        signature = []
+        for name in ('docking_scores.csv', 'checkpoint.jsonl'):
+            try:
+                stat = os.stat(os.path.join(results_dir, name))
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def get(self, results_dir):
+        # Returns None when there is no score table yet
+        signature = self.signature(results_dir)
+        if signature[0] is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(results_dir)
+            if entry and entry[0] == signature:
+                self.entries.move_to_end(results_dir)
+                return entry[1]
+
+        table = ResultsTable.from_csv(os.path.join(results_dir, 'docking_scores.csv'))
+        with self.lock:
+            self.entries[results_dir] = (signature, table)
+            self.entries.move_to_end(results_dir)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return table
@@ -0,0 +1,97 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+
+# Runner output lines the tracker understands (see unidock_multi.py)
+FOUND_RE = re.compile(r'^Found (\d+) (?:ligands|docking jobs)\.(?: Resuming: (\d+) already docked)?')
+DONE_RE = re.compile(r'^>>> .+ docking done\.')
+FAILED_RE = re.compile(r'^>>> Error docking ')
+
+def read_log_chunk(log_path, since=0):
+    # Returns (text, next_offset, reset). Only whole lines are returned so a
+    # multi-byte character or a half-written line is never split; reset is
+    # True when the log was truncated by a new run and reading restarted at 0.
+    try:
+        size = os.path.getsize(log_path)
+    except OSError:
+        return "", since, False
+
+    reset = since > size
+    if reset:
+        since = 0
+
+    with open(log_path, 'rb') as f:
+        f.seek(since)
+        data = f.read(size - since)
+
+    end = data.rfind(b'\n') + 1
+    return data[:end].decode('utf-8', errors='replace'), since + end, reset
+
+class ProgressTracker:
+    # Keeps a running tally per log file. Each call parses only the bytes
+    # appended since the previous call, so a poll costs O(new output).
+    # Only the max_runs most recently polled runs are kept; a run polled
+    # again after being dropped is re-tallied from the start of its log.
+
+    def __init__(self, max_runs=64):
+        self.lock = threading.Lock()
+        self.states = OrderedDict()
+        self.max_runs = max_runs
+
+    def _new_state(self):
+        return {
+            'offset': 0,
+            'total': 0,
+            'done': 0,
+            'failed': 0,
+            'resumed': 0,
+            'first_seen': time.time()
+        }
+
+    def update(self, log_path, started=None):
+        # Keyed by start time too, so a new run reusing the same log path
+        # starts from a fresh tally even if it has already outgrown the old one
+        key = (log_path, started)
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                state = self.states[key] = self._new_state()
+                while len(self.states) > self.max_runs:
+                    self.states.popitem(last=False)
+            self.states.move_to_end(key)
+
+            text, offset, reset = read_log_chunk(log_path, state['offset'])
+            if reset:
+                state = self.states[key] = self._new_state()
+                text, offset, _ = read_log_chunk(log_path, 0)
+            state['offset'] = offset
+
+            for line in text.splitlines():
+                match = FOUND_RE.match(line)
+                if match:
+                    state['total'] = int(match.group(1))
+                    state['resumed'] = int(match.group(2) or 0)
+                    state['done'] = state['resumed']
+                elif DONE_RE.match(line):
+                    state['done'] += 1
+                elif FAILED_RE.match(line):
+                    state['done'] += 1
+                    state['failed'] += 1
+
+            return self._summary(state, started)
+
+    def _summary(self, state, started):
+        elapsed = time.time() - (started or state['first_seen'])
+        processed = state['done'] - state['resumed']
+        rate = processed / elapsed if elapsed > 0 and processed > 0 else 0.0
+        remaining = max(state['total'] - state['done'], 0)
+        return {
+            'done': state['done'],
+            'total': state['total'],
+            'failed': state['failed'],
+            'ligands_per_sec': round(rate, 3),
+            'eta_seconds': round(remaining / rate, 1) if rate > 0 else None,
+            'elapsed_seconds': round(elapsed, 1)
+        }
@@ -87,4 +87,15 @@ function setDockingState(isRunning) {
             btn.innerText = "Start Docking Simulation";
         }
     }
+}
+
+// Poll a queued job until it has finished (used by ligand and receptor prep)
+async function waitForJob(jobId, intervalMs = 1000) {
+    while (true) {
+        const res = await fetch(`/job-status/${jobId}`);
+        const job = await res.json();
+        if (!res.ok) return { status: 'error', message: job.error };
+        if (job.status !== 'queued' && job.status !== 'running') return job;
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+    }
 }
\ No newline at end of file
@@ -24,6 +24,8 @@ window.generateAutoGrid = async function(filepath) {
             body: JSON.stringify({
                 filepath: filepath,
                 mode: "blind",
+                // Ranked pocket sub-boxes, used when docking into the top pockets
+                pockets: true,
             }),
         });
 
@@ -49,7 +51,10 @@ window.generateAutoGrid = async function(filepath) {
             document.getElementById('slider-container').style.display = 'block';
 
             if(statusEl) {
-                statusEl.textContent = "Grid Auto-Generated Successfully";
+                const pocketCount = (result.pockets || []).length;
+                statusEl.textContent = pocketCount
+                    ? `Grid Auto-Generated Successfully (${pocketCount} pockets found)`
+                    : "Grid Auto-Generated Successfully";
                 statusEl.className = "small text-success mb-2";
             }
         } else {
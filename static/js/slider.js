@@ -130,9 +130,14 @@ document.addEventListener('DOMContentLoaded', function() {
                     body: JSON.stringify({ filepath: window.uploadedFilePath, grid: gridData })
                 });
 
-                const data = await res.json();
+                let data = await res.json();
 
-                if (res.ok) {
+                // Receptor prep runs as a queued job; wait for it to finish
+                if (res.ok && data.job_id) {
+                    data = await waitForJob(data.job_id);
+                }
+
+                if (res.ok && data.status !== 'error') {
                     if(statusMsg) {
                         statusMsg.textContent = "Success!";
                         statusMsg.className = "small text-success mb-2";
@@ -150,7 +155,7 @@ document.addEventListener('DOMContentLoaded', function() {
                         }
                     }
                 } else {
-                    alert("Error: " + data.error);
+                    alert("Error: " + (data.error || data.message));
                     if(statusMsg) statusMsg.textContent = "Failed.";
                 }
             } catch (err) {
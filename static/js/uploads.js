@@ -14,8 +14,11 @@ document.getElementById('rec-upload-form').onsubmit = async (event) => {
         return;
     }
 
+    // Several receptors are docked as an ensemble
     const formData = new FormData();
-    formData.append('file', fileInput.files[0]);
+    for (const file of fileInput.files) {
+        formData.append('file', file);
+    }
 
     uploadBtn.disabled = true;
     uploadBtn.textContent = "Uploading...";
@@ -28,7 +31,9 @@ document.getElementById('rec-upload-form').onsubmit = async (event) => {
         const result = await response.json();
 
         if (response.ok) {
-            responseEl.textContent = "Upload Successful!";
+            responseEl.textContent = result.filepaths.length > 1
+                ? `Upload Successful! Ensemble of ${result.filepaths.length} receptors.`
+                : "Upload Successful!";
             responseEl.className = "mb-0 mt-1 small text-success";
             
             // 1. Save filepath
@@ -78,20 +83,28 @@ document.getElementById('lig-upload-form').onsubmit = async (event) => {
 
     const formData = new FormData();
     for (let i = 0; i < files.length; i++) formData.append('files[]', files[i]);
+    formData.append('library', document.getElementById('lig-library-check').checked ? 'true' : 'false');
 
     const btn = document.getElementById('ligUploadBtn');
     btn.disabled = true; btn.innerText = "Uploading...";
 
     try {
         const response = await fetch('/lig_upload', { method: 'POST', body: formData });
-        const result = await response.json();
-        if (response.ok) {
+        let result = await response.json();
+
+        // Conversion runs as a queued job; wait for it to finish
+        if (response.ok && result.job_id) {
+            btn.innerText = "Converting...";
+            result = await waitForJob(result.job_id);
+        }
+
+        if (response.ok && result.status !== 'error') {
             document.getElementById('lig-upload-response').textContent = result.message;
             document.getElementById('lig-upload-response').className = "mt-3 text-center text-success";
             if (typeof unlockStep === 'function') unlockStep(3);
             document.getElementById('paramSetBtn').style.display = 'block';
         } else {
-            document.getElementById('lig-upload-response').textContent = result.error;
+            document.getElementById('lig-upload-response').textContent = result.error || result.message;
             document.getElementById('lig-upload-response').className = "mt-3 text-center text-danger";
         }
     } catch (error) { console.error(error); } 
@@ -147,6 +160,12 @@ document.getElementById('param-upload-form').addEventListener('submit', function
     // We send 'true' or 'false' string so Python can compare it easily
     const isGpu = document.getElementById('use-gpu-check').checked;
     formData.set('use_gpu', isGpu ? 'true' : 'false');
+    formData.set('precompute_maps', document.getElementById('precompute-maps-check').checked ? 'true' : 'false');
+    formData.set('use_bindings', document.getElementById('use-bindings-check').checked ? 'true' : 'false');
+    formData.set('pack_poses', document.getElementById('pack-poses-check').checked ? 'true' : 'false');
+    formData.set('two_stage', document.getElementById('two-stage-check').checked ? 'true' : 'false');
+    formData.set('dedup', document.getElementById('dedup-check').checked ? 'true' : 'false');
+    formData.set('check_box_fit', document.getElementById('box-fit-check').checked ? 'true' : 'false');
     
     // Ensure scoring method is sent even if the dropdown is disabled (defaults to vina)
     if (!isGpu) {
@@ -185,17 +204,32 @@ document.getElementById('run-docking-btn').addEventListener('click', function()
     document.getElementById('download-btn').style.display = 'none';
 
     let pollingInterval;
+    // Byte offset into the run log; each poll only fetches what was added since
+    let logOffset = 0;
+    const progressEl = document.getElementById('run-progress');
+    progressEl.textContent = '';
 
     const pollStatus = () => {
-        fetch('/run-status')
+        fetch(`/run-status?since=${logOffset}`)
             .then(r => r.json())
             .then(data => {
-                if (data.log) { 
-                    logOutput.textContent = data.log; 
-                    logOutput.scrollTop = logOutput.scrollHeight; 
+                if (data.offset !== undefined) {
+                    if (logOffset === 0 || data.reset) logOutput.textContent = '';
+                    if (data.log) {
+                        logOutput.textContent += data.log;
+                        logOutput.scrollTop = logOutput.scrollHeight;
+                    }
+                    logOffset = data.offset;
+                }
+
+                if (data.progress && data.progress.total) {
+                    const p = data.progress;
+                    const eta = p.eta_seconds !== null ? ` | ETA ${Math.round(p.eta_seconds)}s` : '';
+                    progressEl.textContent =
+                        `${p.done} / ${p.total} docked (${p.failed} failed) | ${p.ligands_per_sec} ligands/s${eta}`;
                 }
 
-                if (data.status !== 'running') {
+                if (data.status !== 'running' && data.status !== 'queued') {
                     clearInterval(pollingInterval);
                     runLoader.style.display = 'none';
                     if(typeof setDockingState === "function") setDockingState(false);
@@ -215,10 +249,21 @@ document.getElementById('run-docking-btn').addEventListener('click', function()
             });
     };
 
-    fetch('/run-docking', { method: 'POST' })
+    const resume = document.getElementById('resume-run-check').checked;
+
+    fetch('/run-docking', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ resume: resume })
+    })
         .then(res => res.json())
         .then(data => {
             if (data.message) {
+                // Fitted box volume and cost, reported before the run starts
+                if (data.box) {
+                    document.getElementById('run-final-status').innerHTML =
+                        `<div class="alert alert-info">${data.message}</div>`;
+                }
                 // Start polling
                 pollingInterval = setInterval(pollStatus, 500);
             } else { 
@@ -6,6 +6,1264 @@ import subprocess
 import traceback
 import csv
 import re
+import threading
+import hashlib
+import zlib
+import time
+import shutil
+import tempfile
+import copy
+import math
+import signal
+import importlib.util
+from itertools import islice, groupby, product
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from ligand_prep import LigandLibrary
+from results_store import ResultsStore, STORE_NAME, remove_store, lock_results_dir, lock_holder
+from ligand_filter import LigandFilter
+from receptor_store import link_or_copy
+
+# --- CONFIRM YOUR VINA PATH HERE ---
+VINA_PATH = "/home/atharva/miniconda3/envs/vina/bin/vina"
+
+# Completed ligands, one JSON line each, used to resume an interrupted run
+MANIFEST_NAME = 'checkpoint.jsonl'
+CSV_HEADER = ['Ligand Name', 'Affinity (kcal/mol)', 'Dist from RMSD l.b.']
+# Pre-filter descriptors by ligand content hash (see ligand_filter.py)
+PREFILTER_CACHE = '.prefilter.jsonl'
+# Ligands that still failed after their retries (see FailureLog)
+FAILURES_NAME = 'docking_failures.csv'
+# Ligands dropped by the pre-filter, with the reason
+REJECTED_NAME = 'rejected_ligands.csv'
+
+# Workers share one stdout, so whole lines are printed under a lock
+print_lock = threading.Lock()
+
+def log(msg):
+    with print_lock:
+        print(msg, flush=True)
+
+# --- STRUCTURED EVENTS ---
+
+class EventLog:
+    # Optional JSON-lines event stream (config 'events_path', or --events-fd N
+    # to write to an inherited file descriptor). Also keeps the per-ligand
+    # wall times for the run summary.
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.wall_times = []
+        self.failed = 0
+
+    def emit(self, event, **fields):
+        if event == 'ligand_end':
+            with self.lock:
+                self.wall_times.append(fields['wall_time'])
+                self.failed += fields['exit_code'] != 0
+        if self.stream is None:
+            return
+        record = json.dumps({'event': event, 'time': time.time(), **fields})
+        with self.lock:
+            self.stream.write(record + "\n")
+            self.stream.flush()
+
+    def summary(self, total_ligands, wall_time):
+        times = sorted(self.wall_times)
+
+        def percentile(q):
+            if not times:
+                return None
+            return round(times[min(len(times) - 1, int(q / 100 * len(times)))], 3)
+
+        finished = len(times)
+        self.emit(
+            'run_summary',
+            total=total_ligands,
+            finished=finished,
+            failed=self.failed,
+            wall_time=round(wall_time, 3),
+            ligands_per_sec=round(finished / wall_time, 3) if wall_time > 0 else None,
+            ligand_time_p50=percentile(50),
+            ligand_time_p90=percentile(90),
+            ligand_time_p99=percentile(99),
+            ligand_time_max=times[-1] if times else None
+        )
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+def open_event_log(config, argv):
+    if '--events-fd' in argv:
+        fd = int(argv[argv.index('--events-fd') + 1])
+        # closefd=False leaves the descriptor to its owner (it may be stdout)
+        return EventLog(os.fdopen(fd, 'w', buffering=1, closefd=False))
+    if config.get('events_path'):
+        # A resumed run keeps the events of the run it continues
+        resume = config.get('resume', False) or '--resume' in argv
+        return EventLog(open(config['events_path'], 'a' if resume else 'w', buffering=1))
+    return EventLog()
+
+events = EventLog()
+
+def ligand_stats(ligand_file):
+    # Heavy+polar atom count and torsions from the PDBQT (TORSDOF record)
+    try:
+        with open(ligand_file) as f:
+            return stats_from_lines(f)
+    except OSError:
+        return {'atoms': 0, 'torsions': None}
+
+def stats_from_lines(lines):
+    atoms = 0
+    torsions = None
+    for line in lines:
+        if line.startswith(('ATOM', 'HETATM')):
+            atoms += 1
+        elif line.startswith('TORSDOF'):
+            try:
+                torsions = int(line.split()[1])
+            except (ValueError, IndexError):
+                pass
+    return {'atoms': atoms, 'torsions': torsions}
+
+def docking_cost(stats):
+    # Relative cost estimate: search effort grows with the torsions (search
+    # dimensions) and each evaluation with the number of atoms
+    return stats['atoms'] * (1 + (stats['torsions'] or 0))
+
+def as_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def resolve_workers(config, total_ligands):
+    # Split the available cores between concurrent docking processes,
+    # e.g. 64 cores with max_workers=16 gives 16 jobs x 4 threads each.
+    total_cpu = int(config.get('cpu') or os.cpu_count() or 1)
+    max_workers = int(config.get('max_workers') or 1)
+    max_workers = max(1, min(max_workers, total_ligands, total_cpu))
+    cpu_per_job = max(1, total_cpu // max_workers)
+    return max_workers, cpu_per_job
+
+def build_command(config, ligand_file, cpu_per_job, seed=None):
+    receptor_file = config['receptor']
+    tool = config.get('tool', 'unidock')
+    seed_args = ['--seed', str(seed)] if seed is not None else []
+
+    if tool == 'unidock':
+        return unidock_command(config, ['--ligand', ligand_file]) + seed_args
+
+    elif tool == 'vina':
+        out_file = out_file_for(config, ligand_file)
+        # Precomputed affinity maps replace the receptor when available
+        if config.get('maps_prefix'):
+            receptor_args = ['--maps', config['maps_prefix']]
+        else:
+            receptor_args = ['--receptor', receptor_file]
+        return [
+            config.get('vina_path', VINA_PATH),
+            *receptor_args,
+            '--ligand', ligand_file,
+            '--center_x', str(config["center_x"]),
+            '--center_y', str(config["center_y"]),
+            '--center_z', str(config["center_z"]),
+            '--size_x', str(config["size_x"]),
+            '--size_y', str(config["size_y"]),
+            '--size_z', str(config["size_z"]),
+            '--exhaustiveness', str(config.get("exhaustiveness", 8)),
+            '--num_modes', str(config.get("num_modes", 9)),
+            '--cpu', str(cpu_per_job),
+            '--out', out_file,
+            *seed_args
+        ]
+
+    raise ValueError(f"Unknown docking tool: {tool}")
+
+def unidock_command(config, ligand_args):
+    return [
+        'unidock',
+        '--receptor', config['receptor'],
+        *ligand_args,
+        '--search_mode', config.get("search_mode", "Balanced"),
+        '--scoring', config.get("scoring_method", "vina"),
+        '--exhaustiveness', str(config.get("exhaustiveness", 8)),
+        '--center_x', str(config["center_x"]),
+        '--center_y', str(config["center_y"]),
+        '--center_z', str(config["center_z"]),
+        '--size_x', str(config["size_x"]),
+        '--size_y', str(config["size_y"]),
+        '--size_z', str(config["size_z"]),
+        '--num_modes', str(config.get("num_modes", 9)),
+        '--dir', config['results_dir']
+    ]
+
+# --- PRECOMPUTED AFFINITY MAPS (VINA) ---
+
+def maps_key(config):
+    box = {key: float(config[key]) for key in ('center_x', 'center_y', 'center_z', 'size_x', 'size_y', 'size_z')}
+    box['scoring'] = config.get('scoring_method', 'vina')
+    box['spacing'] = float(config.get('spacing', 0.375))
+    box['receptor'] = file_hash(config['receptor'])
+    return hashlib.sha256(json.dumps(box, sort_keys=True).encode()).hexdigest()
+
+def prepare_vina_maps(config):
+    # Builds the receptor's grid maps once for this box and scoring function
+    # and returns the map prefix for --maps, or None to dock with --receptor.
+    # Maps are cached by receptor hash + box + scoring, so later runs reuse them.
+    cache_dir = config.get('maps_cache_dir') or os.path.join(config['results_dir'], 'maps')
+    os.makedirs(cache_dir, exist_ok=True)
+    map_dir = os.path.join(cache_dir, maps_key(config))
+    prefix = os.path.join(map_dir, 'receptor')
+    if glob.glob(prefix + '*.map'):
+        return prefix
+
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.building-')
+    cmd = [
+        config.get('vina_path', VINA_PATH),
+        '--receptor', config['receptor'],
+        '--scoring', config.get('scoring_method', 'vina'),
+        '--center_x', str(config["center_x"]),
+        '--center_y', str(config["center_y"]),
+        '--center_z', str(config["center_z"]),
+        '--size_x', str(config["size_x"]),
+        '--size_y', str(config["size_y"]),
+        '--size_z', str(config["size_z"]),
+        '--spacing', str(config.get('spacing', 0.375)),
+        '--write_maps', os.path.join(tmp_dir, 'receptor'),
+        '--force_even_voxels'
+    ]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode != 0 or not glob.glob(os.path.join(tmp_dir, 'receptor*.map')):
+            print(f"Map precomputation failed, docking with --receptor instead:\n{result.stdout}", file=sys.stderr)
+            return None
+        try:
+            os.rename(tmp_dir, map_dir)
+        except OSError:
+            pass  # another run built the same maps first; use theirs
+        return prefix
+    except Exception as e:
+        print(f"Map precomputation failed, docking with --receptor instead: {e}", file=sys.stderr)
+        return None
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def out_file_for(config, ligand_file):
+    base_name = os.path.splitext(os.path.basename(ligand_file))[0]
+    return os.path.join(config['results_dir'], f"{base_name}_out.pdbqt")
+
+def job_label(config, ligand_name):
+    # In a multi-target run every ligand is docked once per target
+    target = config.get('target_label')
+    return f"{ligand_name} [{target}]" if target else ligand_name
+
+def read_pose_score(out_file):
+    # Top pose record written by vina/unidock:
+    # REMARK VINA RESULT:    -7.2      0.000      0.000
+    try:
+        with open(out_file) as f:
+            for line in f:
+                if line.startswith('REMARK VINA RESULT:'):
+                    fields = line.split()
+                    return fields[3], fields[4]
+    except OSError:
+        pass
+    return None
+
+# --- CHECKPOINT MANIFEST ---
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def settings_hash(config):
+    # A checkpoint is only reused when the receptor and docking settings match
+    keys = ['tool', 'center_x', 'center_y', 'center_z', 'size_x', 'size_y', 'size_z',
+            'exhaustiveness', 'num_modes', 'search_mode', 'scoring_method']
+    settings = {key: str(config.get(key)) for key in keys}
+    settings['receptor'] = file_hash(config['receptor']) if os.path.exists(config['receptor']) else None
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+def load_manifest(manifest_path):
+    entries = {}
+    if not os.path.exists(manifest_path):
+        return entries
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line may be cut short if the run was killed mid-write
+                continue
+            entries[entry['ligand']] = entry
+    return entries
+
+def ligand_digest(path, data):
+    # Same digest for a file on disk and for a library record's bytes
+    return hashlib.sha256(data).hexdigest() if data is not None else file_hash(path)
+
+def is_checkpointed(config, entry, ligand_name, digest, run_settings, store):
+    if not entry or entry.get('settings') != run_settings:
+        return False
+    # Poses live in the pose file, or only in the store once packed
+    out_file = out_file_for(config, ligand_name)
+    if (not os.path.exists(out_file) or os.path.getsize(out_file) == 0) and not store.has(ligand_name):
+        return False
+    return entry.get('hash') == digest
+
+# --- LIGAND SOURCES ---
+
+def record_range(config, argv):
+    # Slice of a library to dock: --range start:end or config 'record_range'
+    if '--range' in argv:
+        start, _, end = argv[argv.index('--range') + 1].partition(':')
+    else:
+        start, end = config.get('record_range') or (None, None)
+    return int(start or 0), int(end) if end not in (None, '') else None
+
+def shard_spec(config, argv):
+    # This node's share of the ligands: (index, count) from --shard i/N or
+    # config 'shard', 0 <= i < N; None for an unsharded run
+    spec = argv[argv.index('--shard') + 1] if '--shard' in argv else config.get('shard')
+    if not spec:
+        return None
+    index, _, count = str(spec).partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"Invalid shard '{spec}': expected i/N, e.g. 0/8")
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{spec}': expected 0 <= i < N")
+    return index, count
+
+def shard_of(ligand_name, count):
+    # By name, so every node computes the same split whatever order it
+    # lists the ligands in
+    return zlib.crc32(ligand_name.encode()) % count
+
+class LigandSource:
+    # Lazily yields (ligand_name, path, data) from a directory of .pdbqt
+    # files (path set) or from an indexed library (data set, see
+    # ligand_prep.LigandLibrary), so the ligand set is never held in memory.
+
+    def __init__(self, config, argv):
+        self.library = None
+        self.only = None
+        self.skip = set()
+        # Explicit docking order (names, or record indices for a library)
+        self.order = None
+        self.ligand_dir = config.get('ligand_dir')
+        self.shard = shard_spec(config, argv)
+        if config.get('ligand_library'):
+            self.library = LigandLibrary(config['ligand_library'])
+            self.start, end = record_range(config, argv)
+            self.end = len(self.library) if end is None else min(end, len(self.library))
+
+    def __len__(self):
+        if self.library is not None:
+            return sum(1 for _ in self._library_indices())
+        return sum(1 for _ in self.items())
+
+    def subset(self, names):
+        # Same source restricted to the given ligand names
+        source = copy.copy(self)
+        source.only = set(names)
+        return source
+
+    def without(self, names):
+        # Same source minus the given ligand names
+        source = copy.copy(self)
+        source.skip = self.skip | set(names)
+        return source
+
+    def wanted(self, name):
+        if self.shard is not None and shard_of(name, self.shard[1]) != self.shard[0]:
+            return False
+        return name not in self.skip and (self.only is None or name in self.only)
+
+    def by_cost(self):
+        # Same source, most expensive ligands first. Holds one (cost, key)
+        # pair per ligand; the records themselves are still streamed.
+        costs = []
+        if self.library is not None:
+            for i, _, data in self.library.iter_indices(self._library_indices()):
+                costs.append((-docking_cost(stats_from_lines(data.decode(errors='replace').splitlines())), i))
+        else:
+            for name, path, _ in self.items():
+                costs.append((-docking_cost(ligand_stats(path)), name))
+        costs.sort()
+        source = copy.copy(self)
+        source.order = [key for _, key in costs]
+        return source, [-cost for cost, _ in costs]
+
+    def describe(self):
+        shard = f" (shard {self.shard[0]}/{self.shard[1]})" if self.shard else ""
+        if self.library is not None:
+            return f"{self.library.library_path} [{self.start}:{self.end}]{shard}"
+        return self.ligand_dir + shard
+
+    def _library_indices(self):
+        # Names are checked before any record is read
+        for i in (range(self.start, self.end) if self.order is None else self.order):
+            if self.wanted(self.library.names[i] + '.pdbqt'):
+                yield i
+
+    def items(self):
+        if self.library is not None:
+            for _, name, data in self.library.iter_indices(self._library_indices()):
+                yield name + '.pdbqt', None, data
+            return
+        if self.order is not None:
+            for name in self.order:
+                if self.wanted(name):
+                    yield name, os.path.join(self.ligand_dir, name), None
+            return
+        with os.scandir(self.ligand_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.pdbqt') and entry.is_file():
+                    if self.wanted(entry.name):
+                        yield entry.name, entry.path, None
+
+# --- TIMEOUTS, RETRIES AND FAILURES ---
+
+# The median-based timeout only applies once this many ligands have finished
+TIMEOUT_MIN_SAMPLES = 5
+
+class FailureLog:
+    # docking_failures.csv: one row per ligand that still failed after its
+    # retries, with the reason and the tail of the docking program's output
+    HEADER = ['Ligand Name', 'Target', 'Reason', 'Attempts', 'Output (last lines)']
+
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.file = None
+        if path:
+            self.file = open(path, 'w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.HEADER)
+            self.file.flush()
+
+    def record(self, config, ligand_name, reason, attempts, output=""):
+        if self.file is None:
+            return
+        tail = "\n".join(output.strip().splitlines()[-5:])
+        with self.lock:
+            target = config.get('target_label') or os.path.basename(config['receptor'])
+            self.writer.writerow([ligand_name, target, reason, attempts, tail])
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+failures = FailureLog()
+
+def ligand_timeout(config, n_ligands=1):
+    # Wall-clock limit for one docking process, in seconds (None = no limit).
+    # A fixed 'ligand_timeout' wins; otherwise the budget is timeout_factor x
+    # the median time of the ligands finished so far, never below min_timeout.
+    if config.get('ligand_timeout'):
+        return float(config['ligand_timeout']) * n_ligands
+    factor = float(config.get('timeout_factor', 10) or 0)
+    if not factor:
+        return None
+    with events.lock:
+        times = sorted(events.wall_times)
+    if len(times) < TIMEOUT_MIN_SAMPLES:
+        return None
+    budget = max(times[len(times) // 2] * factor, float(config.get('min_timeout', 60)))
+    return budget * n_ligands
+
+def run_docking_process(cmd, budget):
+    # Returns (exit_code, output, timeout); timeout is the limit that was hit,
+    # or None. budget() is re-read every few seconds, so a job started before
+    # the median was known still gets a limit once it is. The program runs in
+    # its own session, so the whole process group (children included) is killed.
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               text=True, start_new_session=True)
+    started = time.time()
+    while True:
+        timeout = budget()
+        wait = 5.0 if timeout is None else min(5.0, max(0.0, started + timeout - time.time()))
+        try:
+            output, _ = process.communicate(timeout=wait)
+            return process.returncode, output, None
+        except subprocess.TimeoutExpired:
+            if timeout is not None and time.time() - started >= timeout:
+                break
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    output, _ = process.communicate()
+    return None, output, timeout
+
+def dock_with_retries(config, ligand_file, cpu_per_job, first_attempt=0):
+    # Docks one ligand, retrying failures, timeouts and clean exits that
+    # wrote no pose with a different seed (config 'retries', default 1).
+    # Returns (score, exit_code, attempts, reason, output); score is
+    # (affinity, rmsd_lb) or None on failure.
+    retries = int(config.get('retries', 1))
+    exit_code, reason, output = -1, "not run", ""
+    out_file = out_file_for(config, ligand_file)
+    attempt = first_attempt
+    for attempt in range(first_attempt, retries + 1):
+        # The first attempt keeps the program's own seed handling
+        seed = None if attempt == 0 else int(config.get('seed') or 0) + attempt
+        # A stale pose from an earlier run must not pass for this attempt's
+        if os.path.exists(out_file):
+            os.remove(out_file)
+        try:
+            exit_code, output, timed_out = run_docking_process(
+                build_command(config, ligand_file, cpu_per_job, seed), lambda: ligand_timeout(config))
+        except Exception as e:
+            print(f"Error executing subprocess: {e}", file=sys.stderr)
+            exit_code, output, timed_out = -1, str(e), None
+
+        # A clean exit only counts when the pose file was written. The score
+        # is the pose file's (3 decimals, as results.sqlite keeps it), not
+        # the rounded one of the stdout table.
+        score = read_pose_score(out_file) if exit_code == 0 else None
+        if score:
+            return score, 0, attempt + 1, None, output
+        if exit_code == 0:
+            exit_code, reason = 1, "no pose written"
+        else:
+            reason = f"timed out after {timed_out:.1f}s" if timed_out else f"exit code {exit_code}"
+        if exit_code is None:
+            exit_code = -1
+        if attempt < retries:
+            log(f"Retrying {job_label(config, os.path.basename(ligand_file))} ({reason}), attempt {attempt + 2} of {retries + 1}")
+    return None, exit_code, attempt + 1, reason, output
+
+def dock_ligand(config, ligand_file, index, total_ligands, cpu_per_job):
+    ligand_name = os.path.basename(ligand_file)
+
+    # LIVE STATUS: Start
+    log(f"Docking {index+1} of {total_ligands}: {job_label(config, ligand_name)}...")
+    worker = threading.current_thread().name
+    started = time.time()
+    events.emit('ligand_start', ligand=ligand_name, index=index, worker=worker)
+
+    # --- 3. EXECUTION & PARSING (SILENT) ---
+    score, exit_code, attempts, reason, output = dock_with_retries(config, ligand_file, cpu_per_job)
+
+    if score:
+        # LIVE STATUS: Done
+        log(f">>> {job_label(config, ligand_name)} docking done. (Affinity: {score[0]})\n")
+        row = [ligand_name, score[0], score[1]]
+    else:
+        log(f">>> Error docking {job_label(config, ligand_name)} ({reason}; see docking_failures.csv)\n")
+        failures.record(config, ligand_name, reason, attempts, output)
+        row = [ligand_name, "ERROR", "ERROR"]
+
+    finished = time.time()
+    events.emit(
+        'ligand_end', ligand=ligand_name, index=index, worker=worker,
+        start=started, end=finished, wall_time=round(finished - started, 3),
+        exit_code=exit_code, attempts=attempts,
+        affinity=as_number(row[1]), **ligand_stats(ligand_file)
+    )
+    return row
+
+def dock_single(config, ligand_file, index, total_ligands, cpu_per_job):
+    return [dock_ligand(config, ligand_file, index, total_ligands, cpu_per_job)]
+
+def dock_batch(config, batch, start_index, total_ligands):
+    # One unidock process docks the whole chunk, reading the ligand paths
+    # from an index file; scores are read back from each *_out.pdbqt.
+    worker = threading.current_thread().name
+    started = time.time()
+    for offset, ligand_file in enumerate(batch):
+        log(f"Docking {start_index+offset+1} of {total_ligands}: {job_label(config, os.path.basename(ligand_file))}...")
+        events.emit('ligand_start', ligand=os.path.basename(ligand_file), index=start_index + offset,
+                    worker=worker, batch=start_index)
+
+    # Stale poses from an earlier run must not be read back as new scores
+    for ligand_file in batch:
+        out_file = out_file_for(config, ligand_file)
+        if os.path.exists(out_file):
+            os.remove(out_file)
+
+    index_path = os.path.join(config['results_dir'], f".ligand_index_{start_index}.txt")
+    with open(index_path, 'w') as f:
+        f.write("\n".join(batch) + "\n")
+
+    exit_code, output, reason = -1, "", None
+    try:
+        exit_code, output, timed_out = run_docking_process(
+            unidock_command(config, ['--ligand_index', index_path]), lambda: ligand_timeout(config, len(batch)))
+        if timed_out:
+            exit_code, reason = -1, f"batch timed out after {timed_out:.1f}s"
+        elif exit_code != 0:
+            reason = f"batch exit code {exit_code}"
+        if reason:
+            print(f"unidock {reason} for batch starting at ligand {start_index+1}", file=sys.stderr)
+    except Exception as e:
+        print(f"Error executing subprocess: {e}", file=sys.stderr)
+        reason, output = "batch could not be started", str(e)
+    finally:
+        os.remove(index_path)
+
+    # Ligands in a batch share one process, so each is charged an equal
+    # share of the batch wall time
+    finished = time.time()
+    share = (finished - started) / len(batch)
+
+    rows = []
+    for offset, ligand_file in enumerate(batch):
+        ligand_name = os.path.basename(ligand_file)
+        score = read_pose_score(out_file_for(config, ligand_file))
+        # A clean exit that left no pose for this ligand still counts as a failure
+        ligand_exit = exit_code if score or exit_code != 0 else 1
+        attempts = 1
+        ligand_reason = reason or "no pose written"
+        ligand_output = output
+        retry_time = 0.0
+        if not score and int(config.get('retries', 1)) > 0:
+            # Isolate the failure: retry this ligand on its own with a new seed,
+            # so one bad ligand does not fail the rest of its batch
+            retry_started = time.time()
+            score, ligand_exit, attempts, ligand_reason, ligand_output = dock_with_retries(
+                config, ligand_file, 1, first_attempt=1)
+            retry_time = time.time() - retry_started
+        if score:
+            log(f">>> {job_label(config, ligand_name)} docking done. (Affinity: {score[0]})\n")
+            rows.append([ligand_name, score[0], score[1]])
+        else:
+            log(f">>> Error docking {job_label(config, ligand_name)} ({ligand_reason}; see docking_failures.csv)\n")
+            failures.record(config, ligand_name, ligand_reason, attempts, ligand_output)
+            rows.append([ligand_name, "ERROR", "ERROR"])
+        events.emit(
+            'ligand_end', ligand=ligand_name, index=start_index + offset, worker=worker, batch=start_index,
+            start=started, end=time.time(), wall_time=round(share + retry_time, 3), exit_code=ligand_exit,
+            attempts=attempts, affinity=as_number(score[0]) if score else None, **ligand_stats(ligand_file)
+        )
+    return rows
+
+# --- IN-PROCESS ENGINE (VINA PYTHON BINDINGS) ---
+# Each pool process sets up the receptor maps once in its initializer and
+# then docks many ligands without starting a vina binary per ligand.
+# There is no child process to kill, so timeouts and retries only apply
+# to the subprocess engine.
+
+worker_vina = None
+worker_config = None
+
+def vina_bindings_available():
+    return importlib.util.find_spec('vina') is not None
+
+def init_vina_worker(config, cpu_per_job):
+    global worker_vina, worker_config
+    from vina import Vina
+
+    sf_name = config.get('scoring_method', 'vina')
+    if sf_name not in ('vina', 'vinardo'):
+        sf_name = 'vina'
+    v = Vina(sf_name=sf_name, cpu=cpu_per_job, verbosity=0)
+    if config.get('maps_prefix'):
+        v.load_maps(config['maps_prefix'])
+    else:
+        v.set_receptor(config['receptor'])
+        # No ligand is set yet, so maps are computed for every atom type
+        v.compute_vina_maps(
+            center=[float(config['center_x']), float(config['center_y']), float(config['center_z'])],
+            box_size=[float(config['size_x']), float(config['size_y']), float(config['size_z'])],
+            spacing=float(config.get('spacing', 0.375))
+        )
+    worker_vina = v
+    worker_config = config
+
+def dock_ligand_bindings(ligand_file, index, total_ligands):
+    # Returns the CSV row and the ligand_end event fields; the parent emits
+    # the event so the run summary sees every ligand.
+    config = worker_config
+    ligand_name = os.path.basename(ligand_file)
+    worker = f"process-{os.getpid()}"
+
+    log(f"Docking {index+1} of {total_ligands}: {ligand_name}...")
+    started = time.time()
+    events.emit('ligand_start', ligand=ligand_name, index=index, worker=worker)
+
+    num_modes = int(config.get("num_modes", 9))
+    try:
+        worker_vina.set_ligand_from_file(ligand_file)
+        worker_vina.dock(exhaustiveness=int(config.get("exhaustiveness", 8)), n_poses=num_modes)
+        worker_vina.write_poses(out_file_for(config, ligand_file), n_poses=num_modes, overwrite=True)
+        best_affinity = float(worker_vina.energies(n_poses=1)[0][0])
+
+        log(f">>> {ligand_name} docking done. (Affinity: {best_affinity:.3f})\n")
+        row = [ligand_name, f"{best_affinity:.3f}", "0.000"]
+        exit_code = 0
+        error = None
+    except Exception as e:
+        print(f"Error docking {ligand_name} in-process: {e}", file=sys.stderr)
+        log(f">>> Error docking {ligand_name} ({e}; see docking_failures.csv)\n")
+        row = [ligand_name, "ERROR", "ERROR"]
+        exit_code = 1
+        error = str(e)
+
+    finished = time.time()
+    fields = dict(
+        ligand=ligand_name, index=index, worker=worker,
+        start=started, end=finished, wall_time=round(finished - started, 3),
+        exit_code=exit_code, affinity=as_number(row[1]), error=error, **ligand_stats(ligand_file)
+    )
+    return row, fields
+
+# --- STREAMED DOCKING LOOP ---
+
+def dock_stream(pool, engine, items, start_index, total_ligands, max_workers, cpu_per_job):
+    # Submits work from the items iterator, (stage, name, path, data) each,
+    # through a bounded window of in-flight jobs. Library records are
+    # written to a scratch file only while their job is in flight. Each
+    # stage's write_rows(rows, digests) is called from this thread only, as
+    # its jobs finish. A Uni-Dock batch never mixes stages (receptors).
+    window = max_workers * 2
+    scratch_dirs = set()
+
+    def batch_size(config):
+        if config.get('tool', 'unidock') == 'unidock' and engine != 'python':
+            return int(config.get('batch_size') or 1)
+        return 1
+
+    def jobs():
+        index = start_index
+        for stage, stage_items in groupby(items, key=lambda item: item[0]):
+            size = batch_size(stage.config)
+            scratch_dir = os.path.join(stage.config['results_dir'], '.ligands_tmp')
+            while True:
+                chunk = list(islice(stage_items, size))
+                if not chunk:
+                    break
+                job = []
+                for _, name, path, data in chunk:
+                    if data is not None:
+                        os.makedirs(scratch_dir, exist_ok=True)
+                        scratch_dirs.add(scratch_dir)
+                        path = os.path.join(scratch_dir, name)
+                        with open(path, 'wb') as f:
+                            f.write(data)
+                    job.append((name, path, ligand_digest(path, data), data is not None))
+                yield index, stage, job
+                index += len(job)
+
+    def submit(index, stage, job):
+        paths = [path for _, path, _, _ in job]
+        if engine == 'python':
+            return pool.submit(dock_ligand_bindings, paths[0], index, total_ligands)
+        if batch_size(stage.config) > 1:
+            return pool.submit(dock_batch, stage.config, paths, index, total_ligands)
+        return pool.submit(dock_single, stage.config, paths[0], index, total_ligands, cpu_per_job)
+
+    def collect(future):
+        stage, job = in_flight.pop(future)
+        if engine == 'python':
+            row, end_fields = future.result()
+            events.emit('ligand_end', **end_fields)
+            if end_fields['error']:
+                failures.record(stage.config, end_fields['ligand'], end_fields['error'], 1)
+            rows = [row]
+        else:
+            rows = future.result()
+        stage.write_rows(rows, {name: digest for name, _, digest, _ in job})
+        for _, path, _, scratch in job:
+            if scratch:
+                os.remove(path)
+
+    in_flight = {}
+    for index, stage, job in jobs():
+        while len(in_flight) >= window:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                collect(future)
+        in_flight[submit(index, stage, job)] = (stage, job)
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            collect(future)
+    for scratch_dir in scratch_dirs:
+        try:
+            os.rmdir(scratch_dir)
+        except OSError:
+            pass  # still in use by another run
+
+# --- DOCKING RUN ---
+
+class Stage:
+    # One results directory being filled: its scores CSV, checkpoint
+    # manifest and results store. On resume the CSV and manifest are
+    # rewritten with the valid checkpointed rows only, and new rows are
+    # appended after them.
+
+    def __init__(self, config, source, resume):
+        self.config = config
+        self.source = source
+        result_dir = config['results_dir']
+        os.makedirs(result_dir, exist_ok=True)
+        self.total = len(source)
+
+        # Checkpoint Setup
+        manifest_path = os.path.join(result_dir, MANIFEST_NAME)
+        self.run_settings = settings_hash(config)
+
+        # Packed poses of every docked ligand (see results_store.py)
+        store_path = config.get('results_store') or os.path.join(result_dir, STORE_NAME)
+        if not resume:
+            remove_store(store_path)
+        self.store = ResultsStore(store_path)
+
+        done_entries = []
+        if resume:
+            manifest = load_manifest(manifest_path)
+            for name, path, data in source.items():
+                entry = manifest.get(name)
+                if entry and is_checkpointed(config, entry, name, ligand_digest(path, data), self.run_settings, self.store):
+                    done_entries.append(entry)
+            del manifest
+        self.done_names = {entry['ligand'] for entry in done_entries}
+        self.done_count = len(done_entries)
+
+        # CSV Setup
+        self.csv_path = os.path.join(result_dir, 'docking_scores.csv')
+        self.csv_file = open(self.csv_path, 'w', newline='')
+        self.csv_writer = csv.writer(self.csv_file)
+        self.csv_writer.writerow(CSV_HEADER)
+        self.manifest_file = open(manifest_path, 'w')
+        for entry in done_entries:
+            self.csv_writer.writerow([entry['ligand'], entry['affinity'], entry['rmsd_lb']])
+            self.manifest_file.write(json.dumps(entry) + "\n")
+        self.csv_file.flush()
+        self.manifest_file.flush()
+
+    @property
+    def remaining(self):
+        return self.total - self.done_count
+
+    def pending(self):
+        # (stage, name, path, data) for every ligand not checkpointed yet
+        for name, path, data in self.source.items():
+            if name not in self.done_names:
+                yield self, name, path, data
+
+    def write_rows(self, rows, digests):
+        # A ligand only counts as docked once its poses are stored; one
+        # reported as docked without a pose file is recorded as a failure
+        checked = []
+        for ligand_name, affinity, rmsd_lb in rows:
+            if affinity != "ERROR":
+                out_file = out_file_for(self.config, ligand_name)
+                if not self.store.add(ligand_name, out_file):
+                    failures.record(self.config, ligand_name, "no pose written", 1)
+                    affinity = rmsd_lb = "ERROR"
+                else:
+                    # With pack_poses the store keeps the only copy of the poses
+                    if self.config.get('pack_poses'):
+                        os.remove(out_file)
+                    self.manifest_file.write(json.dumps({
+                        'ligand': ligand_name,
+                        'hash': digests[ligand_name],
+                        'settings': self.run_settings,
+                        'affinity': affinity,
+                        'rmsd_lb': rmsd_lb
+                    }) + "\n")
+            checked.append([ligand_name, affinity, rmsd_lb])
+        self.csv_writer.writerows(checked)
+        self.csv_file.flush()
+        self.manifest_file.flush()
+
+    def close(self):
+        self.csv_file.close()
+        self.manifest_file.close()
+        self.store.close()
+
+def announce_run(tool, total, done_count, unit='ligands'):
+    # START MESSAGE (the web app's progress tracker reads the "Found" line)
+    print(f"--- Starting Docking Run with {tool.upper()} ---", flush=True)
+    if done_count:
+        print(f"Found {total} {unit}. Resuming: {done_count} already docked, {total - done_count} remaining.\n", flush=True)
+    else:
+        print(f"Found {total} {unit}.\n", flush=True)
+
+def run_stage(config, source, resume):
+    # Docks every ligand of the source into config['results_dir'] and
+    # returns the path of the scores CSV
+    tool = config.get('tool', 'unidock')
+    stage = Stage(config, source, resume)
+
+    # Ligands that failed after all retries; rewritten each run since a
+    # resumed run tries them again
+    global failures
+    failures = FailureLog(os.path.join(config['results_dir'], FAILURES_NAME))
+
+    if not stage.remaining:
+        stage.close()
+        failures.close()
+        print(f"All {stage.total} ligands already docked; nothing to resume.", flush=True)
+        return stage.csv_path
+
+    max_workers, cpu_per_job = resolve_workers(config, stage.remaining)
+
+    if tool == 'vina' and config.get('precompute_maps'):
+        config['maps_prefix'] = prepare_vina_maps(config)
+
+    announce_run(tool, stage.total, stage.done_count)
+
+    # --- 2. DOCKING POOL ---
+    # 'subprocess' engine: each worker thread only waits on its own
+    # docking subprocess, so max_workers is the number of concurrent
+    # vina/unidock processes. 'python' engine: long-lived worker
+    # processes dock through the Vina bindings.
+    engine = config.get('engine', 'subprocess')
+    if engine == 'python' and (tool != 'vina' or not vina_bindings_available()):
+        print("Vina Python bindings not available for this run; using the subprocess engine.", flush=True)
+        engine = 'subprocess'
+
+    events.emit('run_start', tool=tool, engine=engine, total=stage.total, resumed=stage.done_count,
+                workers=max_workers, cpu_per_job=cpu_per_job)
+    if engine == 'python':
+        pool = ProcessPoolExecutor(max_workers=max_workers, initializer=init_vina_worker,
+                                   initargs=(config, cpu_per_job))
+    else:
+        pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='worker')
+
+    with pool:
+        dock_stream(pool, engine, stage.pending(), stage.done_count, stage.total, max_workers, cpu_per_job)
+
+    stage.close()
+    failures.close()
+    print("--- Docking Run Completed Successfully ---", flush=True)
+    return stage.csv_path
+
+def append_rejected(csv_path, rejected):
+    # Filtered ligands stay visible in the scores table, marked REJECTED in
+    # the score columns like ERROR rows; the reasons go to rejected_ligands.csv
+    with open(csv_path, newline='') as f:
+        width = len(next(csv.reader(f), CSV_HEADER))
+    with open(csv_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        for name in rejected:
+            writer.writerow([name, "REJECTED", "REJECTED"] + [""] * (width - 3))
+    with open(os.path.join(os.path.dirname(csv_path), REJECTED_NAME), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Ligand Name', 'Reason'])
+        writer.writerows(rejected.items())
+
+# --- TWO-STAGE SCREENING ---
+# Stage one docks everything with cheap settings into results/screen;
+# stage two re-docks the best of them with the configured settings. The
+# final CSV keeps every ligand, with its screen score and the stage its
+# reported score comes from.
+
+TWO_STAGE_HEADER = CSV_HEADER + ['Screen Affinity (kcal/mol)', 'Stage']
+
+def screen_config(config):
+    return {
+        **config,
+        'results_dir': os.path.join(config['results_dir'], 'screen'),
+        'results_store': None,
+        'exhaustiveness': config.get('screen_exhaustiveness') or min(4, int(config.get('exhaustiveness', 8))),
+        'search_mode': config.get('screen_search_mode') or 'Fast',
+        'num_modes': config.get('screen_num_modes') or 1
+    }
+
+def read_scores(csv_path):
+    # {ligand: (affinity, rmsd_lb)} in file order
+    with open(csv_path, newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return {row[0]: (row[1], row[2]) for row in reader if len(row) >= 3}
+
+def select_for_refinement(scores, top_percent=None, cutoff=None):
+    # Top X% of the docked ligands, plus every ligand at or below the cutoff
+    docked = sorted((float(affinity), name) for name, (affinity, _) in scores.items()
+                    if as_number(affinity) is not None)
+    selected = set()
+    if top_percent:
+        selected.update(name for _, name in docked[:math.ceil(len(docked) * float(top_percent) / 100)])
+    if cutoff is not None and cutoff != '':
+        selected.update(name for affinity, name in docked if affinity <= float(cutoff))
+    return selected
+
+def run_two_stage(config, source, resume):
+    print("=== Stage 1 of 2: screening all ligands with fast settings ===", flush=True)
+    screen_csv = run_stage(screen_config(config), source, resume)
+    screen_scores = read_scores(screen_csv)
+
+    selected = select_for_refinement(screen_scores, config.get('refine_top_percent', 10), config.get('refine_cutoff'))
+    print(f"=== Stage 2 of 2: refining {len(selected)} of {len(screen_scores)} ligands ===", flush=True)
+    refined_scores = {}
+    if selected:
+        refined_scores = read_scores(run_stage(config, source.subset(selected), resume))
+
+    # Both stages in one table; the reported affinity is the refined one
+    # where a ligand was re-docked successfully
+    csv_path = os.path.join(config['results_dir'], 'docking_scores.csv')
+    with open(csv_path + '.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(TWO_STAGE_HEADER)
+        for name, (affinity, rmsd_lb) in screen_scores.items():
+            refined = refined_scores.get(name)
+            if refined and refined[0] != "ERROR":
+                writer.writerow([name, refined[0], refined[1], affinity, 'refine'])
+            else:
+                writer.writerow([name, affinity, rmsd_lb, affinity, 'screen'])
+    os.replace(csv_path + '.tmp', csv_path)
+    return csv_path
+
+# --- ENSEMBLE AND POCKET DOCKING ---
+# Every ligand is docked against several targets: each receptor in
+# config['receptors'] (ensemble), each box in config['pockets'] (a blind
+# box split into detected pockets), or every receptor x pocket pair. All
+# (target, ligand) jobs share one worker pool. Each target keeps its own
+# results in results/targets/<name>; docking_scores.csv becomes the
+# consensus table, ranked by the best (min) affinity over the targets.
+
+TARGETS_DIR = 'targets'
+BOX_KEYS = ('center_x', 'center_y', 'center_z', 'size_x', 'size_y', 'size_z')
+
+def receptor_labels(receptors):
+    # File stems, made unique: they name the result dirs and CSV columns
+    labels = []
+    for path in receptors:
+        base = label = os.path.splitext(os.path.basename(path))[0]
+        n = 1
+        while label in labels:
+            n += 1
+            label = f"{base}_{n}"
+        labels.append(label)
+    return labels
+
+def docking_targets(config):
+    # [(label, config overrides), ...]; one unlabelled target when there
+    # is neither an ensemble nor a pocket list
+    receptors = config.get('receptors') or []
+    receptor_targets = [(None, {})]
+    if len(receptors) > 1:
+        receptor_targets = [(label, {'receptor': path}) for label, path in zip(receptor_labels(receptors), receptors)]
+    pocket_targets = [(f"pocket_{i}", {key: pocket[key] for key in BOX_KEYS})
+                      for i, pocket in enumerate(config.get('pockets') or [], start=1)] or [(None, {})]
+    return [('_'.join(label for label in (receptor_label, pocket_label) if label) or None, {**receptor, **pocket})
+            for (receptor_label, receptor), (pocket_label, pocket) in product(receptor_targets, pocket_targets)]
+
+def target_kind(config):
+    # Column title for the best target in the consensus table
+    if config.get('pockets'):
+        return 'Target' if len(config.get('receptors') or []) > 1 else 'Pocket'
+    return 'Receptor'
+
+def target_config(config, label, overrides):
+    return {
+        **config,
+        **overrides,
+        'target_label': label,
+        'results_dir': os.path.join(config['results_dir'], TARGETS_DIR, label),
+        'results_store': None,
+        'maps_prefix': None
+    }
+
+def consensus_header(labels, kind='Target'):
+    return CSV_HEADER + ['Mean Affinity (kcal/mol)', f'Best {kind}'] + [f"{label} (kcal/mol)" for label in labels]
+
+def write_consensus(csv_path, labels, scores, kind='Target'):
+    # scores: one {ligand: (affinity, rmsd_lb)} per target. The reported
+    # affinity and RMSD are the best target's; ERROR if none docked it.
+    names = dict.fromkeys(name for target_scores in scores for name in target_scores)
+    with open(csv_path + '.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(consensus_header(labels, kind))
+        for name in names:
+            per_target = [target_scores.get(name, ("ERROR", "ERROR")) for target_scores in scores]
+            docked = [(float(affinity), i) for i, (affinity, _) in enumerate(per_target)
+                      if as_number(affinity) is not None]
+            affinities = [affinity for affinity, _ in per_target]
+            if docked:
+                best = min(docked)[1]
+                mean = sum(affinity for affinity, _ in docked) / len(docked)
+                writer.writerow([name, *per_target[best], f"{mean:.3f}", labels[best], *affinities])
+            else:
+                writer.writerow([name, "ERROR", "ERROR", "ERROR", "", *affinities])
+    os.replace(csv_path + '.tmp', csv_path)
+
+def run_targets(config, source, resume, targets):
+    tool = config.get('tool', 'unidock')
+    labels = [label for label, _ in targets]
+    stages = [Stage(target_config(config, label, overrides), source, resume) for label, overrides in targets]
+
+    # One failures table for the whole run (it names the target)
+    global failures
+    failures = FailureLog(os.path.join(config['results_dir'], FAILURES_NAME))
+
+    total = sum(stage.total for stage in stages)
+    done_count = sum(stage.done_count for stage in stages)
+    print(f"Docking {stages[0].total} ligands against {len(stages)} targets ({', '.join(labels)}).", flush=True)
+    if done_count == total:
+        print(f"All {total} docking jobs already done; nothing to resume.", flush=True)
+    else:
+        max_workers, cpu_per_job = resolve_workers(config, total - done_count)
+        if tool == 'vina' and config.get('precompute_maps'):
+            for stage in stages:
+                stage.config['maps_prefix'] = prepare_vina_maps(stage.config)
+
+        announce_run(tool, total, done_count, unit='docking jobs')
+        # A bindings worker holds a single receptor and box
+        if config.get('engine') == 'python':
+            print("Multi-target runs use the subprocess engine.", flush=True)
+        events.emit('run_start', tool=tool, engine='subprocess', total=total, resumed=done_count,
+                    workers=max_workers, cpu_per_job=cpu_per_job, targets=labels)
+
+        # Target-major order keeps each Uni-Dock batch on one target; the
+        # pool starts on the next target while the previous one's last jobs
+        # are still running, so it never drains between targets
+        items = (item for stage in stages for item in stage.pending())
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='worker') as pool:
+            dock_stream(pool, 'subprocess', items, done_count, total, max_workers, cpu_per_job)
+        print("--- Docking Run Completed Successfully ---", flush=True)
+
+    for stage in stages:
+        stage.close()
+    failures.close()
+
+    csv_path = os.path.join(config['results_dir'], 'docking_scores.csv')
+    write_consensus(csv_path, labels, [read_scores(stage.csv_path) for stage in stages], target_kind(config))
+    return csv_path
+
+# --- SHARDED RUNS ---
+# The same config can be launched on many nodes sharing a filesystem,
+# e.g. a SLURM array running `unidock_multi.py config.json --shard
+# $SLURM_ARRAY_TASK_ID/8`. Each shard docks its ligands into
+# results/shards/shard_<i>_of_<N> and marks it finished with shard.json;
+# `unidock_multi.py config.json --merge` then combines the shards into
+# results/ as if one node had docked everything.
+
+SHARDS_DIR = 'shards'
+SHARD_MARKER = 'shard.json'
+SHARD_DIR_RE = re.compile(r'shard_(\d+)_of_(\d+)')
+
+def shard_config(config, shard):
+    # The shard's own results dir; its event log goes there too
+    shard_dir = os.path.join(config['results_dir'], SHARDS_DIR, f"shard_{shard[0]}_of_{shard[1]}")
+    overrides = {'results_dir': shard_dir, 'results_store': None}
+    if config.get('events_path'):
+        overrides['events_path'] = os.path.join(shard_dir, os.path.basename(config['events_path']))
+    return {**config, **overrides}
+
+def finish_shard(config, shard, total_ligands, rejected):
+    with open(os.path.join(config['results_dir'], SHARD_MARKER), 'w') as f:
+        json.dump({'shard': shard[0], 'of': shard[1], 'ligands': total_ligands,
+                   'rejected': rejected, 'finished': time.time()}, f)
+    print(f"Shard {shard[0]}/{shard[1]} finished; run with --merge once every shard is done.", flush=True)
+
+def merge_scores(csv_path, sources):
+    # One table from the shards' CSVs, best affinity first; failed and
+    # rejected ligands follow in shard order. Returns (docked, other).
+    header = None
+    docked = []
+    other = []
+    for source in sources:
+        with open(source, newline='') as f:
+            reader = csv.reader(f)
+            source_header = next(reader, None)
+            if header is None:
+                header = source_header
+            elif source_header != header:
+                raise ValueError(f"{source} has different columns than the other shards")
+            for row in reader:
+                (docked if as_number(row[1]) is not None else other).append(row)
+    docked.sort(key=lambda row: float(row[1]))
+    with open(csv_path + '.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(docked)
+        writer.writerows(other)
+    os.replace(csv_path + '.tmp', csv_path)
+    return len(docked), len(other)
+
+def concatenate(path, sources, header=False):
+    # Shard files back to back; with header, only the first one's is kept
+    with open(path + '.tmp', 'wb') as out:
+        for i, source in enumerate(sources):
+            with open(source, 'rb') as f:
+                if header and i:
+                    f.readline()
+                shutil.copyfileobj(f, out)
+    os.replace(path + '.tmp', path)
+
+def merge_shards(config, partial=False):
+    # Combines every shard's results into config['results_dir'], keeping the
+    # layout of an unsharded run (targets/ and screen/ included): scores
+    # CSVs ranked, failures and checkpoints concatenated, results stores
+    # merged and pose files linked. A later --resume without --shard
+    # reuses the merged checkpoint. Returns the exit code.
+    results_dir = config['results_dir']
+    found = {}
+    for path in glob.glob(os.path.join(results_dir, SHARDS_DIR, 'shard_*_of_*')):
+        match = SHARD_DIR_RE.fullmatch(os.path.basename(path))
+        if match:
+            found[(int(match.group(1)), int(match.group(2)))] = path
+    counts = {count for _, count in found}
+    if not counts:
+        print(f"Error: No shard results found in {os.path.join(results_dir, SHARDS_DIR)}", file=sys.stderr)
+        return 1
+    if len(counts) > 1:
+        print(f"Error: Shards from runs with different shard counts ({', '.join(map(str, sorted(counts)))}); "
+              f"remove the stale ones first.", file=sys.stderr)
+        return 1
+
+    count = counts.pop()
+    finished = [found[(i, count)] for i in range(count)
+                if (i, count) in found and os.path.exists(os.path.join(found[(i, count)], SHARD_MARKER))]
+    if len(finished) < count:
+        missing = [str(i) for i in range(count) if found.get((i, count)) not in finished]
+        message = f"Shards not finished: {', '.join(missing)} of {count}."
+        if not partial:
+            print(f"Error: {message} Re-run them, or pass --partial to merge the finished ones.", file=sys.stderr)
+            return 1
+        print(f"{message} Merging the {len(finished)} finished shards only.", flush=True)
+
+    # Same relative path in every shard -> one merged file
+    files = {}
+    for shard_dir in finished:
+        for root, dirs, names in os.walk(shard_dir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != 'maps')
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                files.setdefault(os.path.relpath(path, shard_dir), []).append(path)
+
+    poses = 0
+    for relative, sources in files.items():
+        target = os.path.join(results_dir, relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        name = os.path.basename(relative)
+        if name == 'docking_scores.csv':
+            docked, other = merge_scores(target, sources)
+            if relative == name:
+                print(f"Merged {docked + other} ligands from {len(finished)} shards "
+                      f"({docked} docked, {other} failed or rejected).", flush=True)
+        elif name in (FAILURES_NAME, REJECTED_NAME):
+            concatenate(target, sources, header=True)
+        elif name == MANIFEST_NAME:
+            concatenate(target, sources)
+        elif name == STORE_NAME:
+            remove_store(target)
+            store = ResultsStore(target)
+            for source in sources:
+                store.merge(source)
+            store.close()
+        elif name.endswith('_out.pdbqt'):
+            # Each ligand is in exactly one shard
+            link_or_copy(sources[0], target)
+            poses += 1
+    print(f"Linked {poses} pose files.", flush=True)
+    print(f"Scores saved to: {os.path.join(results_dir, 'docking_scores.csv')}", flush=True)
+    return 0
 
 def main():
     sys.stdout.reconfigure(line_buffering=True)
@@ -18,124 +1276,102 @@ def main():
         config_path = sys.argv[1]
         with open(config_path) as f:
             config = json.load(f)
+        # --cpu N: the cores this run may use, when the host is shared
+        if '--cpu' in sys.argv[2:]:
+            config['cpu'] = int(sys.argv[sys.argv.index('--cpu') + 1])
 
-        receptor_file = config['receptor']
-        ligand_dir = config['ligand_dir']
-        result_dir = config['results_dir']
-        tool = config.get('tool', 'unidock')
-        
-        os.makedirs(result_dir, exist_ok=True)
+        # --merge combines finished shards; --shard i/N docks one of them
+        if '--merge' in sys.argv[2:]:
+            sys.exit(merge_shards(config, partial='--partial' in sys.argv[2:]))
+        shard = shard_spec(config, sys.argv[2:])
+        if shard:
+            config = shard_config(config, shard)
+            os.makedirs(config['results_dir'], exist_ok=True)
+            # A shard being re-run is not finished until it ends again
+            if os.path.exists(os.path.join(config['results_dir'], SHARD_MARKER)):
+                os.remove(os.path.join(config['results_dir'], SHARD_MARKER))
 
-        # CSV Setup
-        csv_path = os.path.join(result_dir, 'docking_scores.csv')
-        csv_file = open(csv_path, 'w', newline='')
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(['Ligand Name', 'Affinity (kcal/mol)', 'Dist from RMSD l.b.'])
-
-        # Find Ligands
-        allowed_extensions = ['*.pdbqt']
-        ligand_files = []
-        for ext in allowed_extensions:
-            ligand_files.extend(glob.glob(os.path.join(ligand_dir, ext)))
-        
-        total_ligands = len(ligand_files)
+        global events
+        events = open_event_log(config, sys.argv[2:])
+        run_started = time.time()
+
+        os.makedirs(config['results_dir'], exist_ok=True)
+        # One runner per results dir; held until this process exits
+        run_lock = lock_results_dir(config['results_dir'])
+        if run_lock is None:
+            print(f"Error: another run (PID {lock_holder(config['results_dir'])}) is still writing to "
+                  f"{config['results_dir']}.", file=sys.stderr)
+            sys.exit(1)
+
+        # Several receptors (ensemble) and/or pocket boxes, one ligand set;
+        # a single pocket just replaces the box
+        targets = docking_targets(config)
+        multi_target = len(targets) > 1
+        if not multi_target:
+            config.update(targets[0][1])
+        elif config.get('two_stage'):
+            print("Two-stage screening is not used when docking against several targets.", flush=True)
+
+        # Find Ligands (streamed; only the count is taken up front)
+        source = LigandSource(config, sys.argv[2:])
+        total_ligands = len(source)
         if total_ligands == 0:
-            print(f"Error: No .pdbqt files found in {ligand_dir}", file=sys.stderr)
+            if shard:
+                # A small set split many ways can leave a shard empty
+                print(f"No ligands fall in {source.describe()}.", flush=True)
+                finish_shard(config, shard, 0, 0)
+                sys.exit(0)
+            print(f"Error: No .pdbqt ligands found in {source.describe()}", file=sys.stderr)
             sys.exit(0)
 
-        # START MESSAGE
-        print(f"--- Starting Docking Run with {tool.upper()} ---", flush=True)
-        print(f"Found {total_ligands} ligands.\n", flush=True)
-
-        # --- 2. DOCKING LOOP ---
-        for i, ligand_file in enumerate(ligand_files):
-            ligand_name = os.path.basename(ligand_file)
-            base_name = os.path.splitext(ligand_name)[0]
-            
-            # LIVE STATUS: Start
-            print(f"Docking {i+1} of {total_ligands}: {ligand_name}...", flush=True)
-
-            cmd = []
-            
-            if tool == 'unidock':
-                cmd = [
-                    'unidock', 
-                    '--receptor', receptor_file, 
-                    '--ligand', ligand_file,
-                    '--search_mode', config.get("search_mode", "Balanced"),
-                    '--scoring', config.get("scoring_method", "vina"),
-                    '--exhaustiveness', str(config.get("exhaustiveness", 8)),
-                    '--center_x', str(config["center_x"]),
-                    '--center_y', str(config["center_y"]),
-                    '--center_z', str(config["center_z"]),
-                    '--size_x', str(config["size_x"]),
-                    '--size_y', str(config["size_y"]),
-                    '--size_z', str(config["size_z"]),
-                    '--num_modes', str(config.get("num_modes", 9)),
-                    '--dir', result_dir
-                ]
-            
-            elif tool == 'vina':
-                # --- CONFIRM YOUR VINA PATH HERE ---
-                vina_path = "/home/atharva/miniconda3/envs/vina/bin/vina" 
-                
-                out_file = os.path.join(result_dir, f"{base_name}_out.pdbqt")
-                cmd = [
-                    vina_path,
-                    '--receptor', receptor_file,
-                    '--ligand', ligand_file,
-                    '--center_x', str(config["center_x"]),
-                    '--center_y', str(config["center_y"]),
-                    '--center_z', str(config["center_z"]),
-                    '--size_x', str(config["size_x"]),
-                    '--size_y', str(config["size_y"]),
-                    '--size_z', str(config["size_z"]),
-                    '--exhaustiveness', str(config.get("exhaustiveness", 8)),
-                    '--num_modes', str(config.get("num_modes", 9)),
-                    '--out', out_file
-                ]
-
-            # --- 3. EXECUTION & PARSING (SILENT) ---
-            best_affinity = "N/A"
-            rmsd_lb = "N/A"
+        # Pre-docking filter: duplicates, size limits and box fit
+        rejected = {}
+        if LigandFilter.enabled(config):
+            print("Pre-filtering ligands...", flush=True)
+            if shard and config.get('dedup'):
+                print("Duplicates are only found within this shard.", flush=True)
+            # With several pockets a ligand is too large only if it fits none
+            filter_config = config
+            if multi_target and config.get('pockets'):
+                widest = max(config['pockets'], key=lambda box: sum(float(box[key]) ** 2 for key in BOX_KEYS[3:]))
+                filter_config = {**config, **{key: widest[key] for key in BOX_KEYS}}
+            ligand_filter = LigandFilter(filter_config, os.path.join(config['results_dir'], PREFILTER_CACHE))
+            rejected = ligand_filter.run(source.items(), resolve_workers(config, total_ligands)[0] * 2)
+            print(f"Pre-filter rejected {len(rejected)} of {total_ligands} ligands.", flush=True)
+            source = source.without(rejected)
 
-            try:
-                process = subprocess.Popen(
-                    cmd, 
-                    stdout=subprocess.PIPE, 
-                    stderr=subprocess.STDOUT, 
-                    text=True, 
-                    bufsize=1, 
-                    universal_newlines=True
-                )
-
-                # Process output line by line but DO NOT PRINT IT
-                for line in process.stdout:
-                    # Regex to capture the FIRST score (Rank 1)
-                    # Vina table format:   1         -7.2      0.000      0.000
-                    if best_affinity == "N/A":
-                        match = re.search(r'^\s+1\s+(-?\d+\.\d+)\s+(\d+\.\d+)', line)
-                        if match:
-                            best_affinity = match.group(1)
-                            rmsd_lb = match.group(2)
-                
-                process.wait()
-
-                if process.returncode == 0:
-                    # LIVE STATUS: Done
-                    print(f">>> {ligand_name} docking done. (Affinity: {best_affinity})\n", flush=True)
-                    csv_writer.writerow([ligand_name, best_affinity, rmsd_lb])
-                else:
-                    print(f">>> Error docking {ligand_name} (Check console for details)\n", flush=True)
-                    csv_writer.writerow([ligand_name, "ERROR", "ERROR"])
+        # Longest job first: an expensive ligand started last would leave
+        # the run waiting on one straggler. Also makes Uni-Dock batches
+        # size-homogeneous, since consecutive ligands have similar cost.
+        if config.get('schedule', 'longest_first') == 'longest_first' and len(rejected) < total_ligands:
+            source, costs = source.by_cost()
+            print(f"Scheduling {len(costs)} ligands longest-first (cost {costs[0]} down to {costs[-1]}).", flush=True)
 
-            except Exception as e:
-                print(f"Error executing subprocess: {e}", file=sys.stderr)
-                csv_writer.writerow([ligand_name, "ERROR", "ERROR"])
+        resume = config.get('resume', False) or '--resume' in sys.argv[2:]
+        if len(rejected) == total_ligands:
+            csv_path = os.path.join(config['results_dir'], 'docking_scores.csv')
+            if multi_target:
+                header = consensus_header([label for label, _ in targets], target_kind(config))
+            else:
+                header = TWO_STAGE_HEADER if config.get('two_stage') else CSV_HEADER
+            with open(csv_path, 'w', newline='') as f:
+                csv.writer(f).writerow(header)
+        elif multi_target:
+            csv_path = run_targets(config, source, resume, targets)
+        elif config.get('two_stage'):
+            csv_path = run_two_stage(config, source, resume)
+        else:
+            csv_path = run_stage(config, source, resume)
+        if rejected:
+            append_rejected(csv_path, rejected)
+        elif os.path.exists(os.path.join(config['results_dir'], REJECTED_NAME)):
+            os.remove(os.path.join(config['results_dir'], REJECTED_NAME))
 
-        csv_file.close()
-        print("--- Docking Run Completed Successfully ---", flush=True)
+        events.summary(total_ligands * len(targets), time.time() - run_started)
+        events.close()
         print(f"Scores saved to: {csv_path}", flush=True)
+        if shard:
+            finish_shard(config, shard, total_ligands, len(rejected))
 
     except Exception as e:
         print(f"Critical Script Error: {e}", file=sys.stderr)
@@ -143,4 +1379,4 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()